@@ -0,0 +1,180 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Callable, Tuple, Any
+from pydantic import BaseModel, Field
+
+from agent_manager import Button, Action, PENDING_CONFIRMATION
+from notion_client import NotionClient, DB_CONFIG, build_task_properties
+
+# ---------------------------------------------------------------------------
+# 卡片按钮快速通道：飞书卡片回调 (card_action) 不进入 LLM 流水线，
+# 直接按 action_payload 分发到本地处理器，毫秒级完成 Notion / 记忆操作
+# payload 格式: "<动作名>" 或 "<动作名>:<参数>"，例如 "confirm_task:<feishu_messages.id>"
+# ---------------------------------------------------------------------------
+
+IDEA_TYPE = "💡 闪念灵感"
+TASK_TYPE = "🛠️ 任务"
+CONFIRMED = "已确认"
+CONVERTED = "已转待办"
+
+
+class ActionResult(BaseModel):
+    reply: Optional[str] = Field(None, description="直接回复给老板的卡片文案，为空则不回复")
+    buttons: List[Button] = Field(default_factory=list, description="回复卡片上的按钮")
+    llm_message: Optional[str] = Field(None, description="需要交给大总管 (LLM) 继续处理的消息，为空则不调用 LLM")
+
+
+ActionHandler = Callable[[object, str, Optional[str], object], ActionResult]
+
+ACTION_HANDLERS: Dict[str, ActionHandler] = {}
+
+
+def register_action(name: str):
+    """注册卡片按钮处理器: handler(manager, user_id, arg, supabase) -> ActionResult"""
+    def decorator(func: ActionHandler) -> ActionHandler:
+        ACTION_HANDLERS[name] = func
+        return func
+    return decorator
+
+
+def parse_payload(payload: str) -> Tuple[str, Optional[str]]:
+    name, _, arg = (payload or "").strip().partition(":")
+    return name, (arg or None)
+
+
+async def dispatch_card_action(manager, user_id: str, payload: str, supabase=None) -> ActionResult:
+    """分发卡片动作；未注册的 payload 交给 LLM 当作普通指令理解"""
+    name, arg = parse_payload(payload)
+    handler = ACTION_HANDLERS.get(name)
+    if not handler:
+        print(f"[Card Action] 未注册的按钮动作 {name}，转交大总管处理")
+        return ActionResult(llm_message=payload)
+
+    print(f"[Card Action] 本地处理按钮动作 {name} (参数: {arg})")
+    # Notion 与 Supabase 客户端为同步请求，放到线程中执行避免阻塞事件循环
+    return await asyncio.to_thread(handler, manager, user_id, arg, supabase)
+
+
+# ---------------------------------------------------------------------------
+# 待确认动作：Router 给出 next='等待确认' 的 create_task 不会直接执行，
+# 完成路径在卡片上附加携带消息 ID 的按钮，点击后由下面的处理器读回该动作写入 Notion
+# ---------------------------------------------------------------------------
+
+def _is_task_creation(action: Dict[str, Any]) -> bool:
+    return action.get("type") == "create_task" and (action.get("database") or "").lower() == "tasks"
+
+
+def _is_idea(action: Dict[str, Any]) -> bool:
+    return (action.get("data") or {}).get("Type") == IDEA_TYPE
+
+
+def confirmation_buttons(record_id: str, actions: List[Action]) -> List[Button]:
+    """为消息中待确认的任务 / 灵感生成确认按钮 (payload 携带 feishu_messages.id)"""
+    pending = [a.model_dump() for a in actions if PENDING_CONFIRMATION in (a.next or "")]
+    pending = [a for a in pending if _is_task_creation(a)]
+    if not pending:
+        return []
+    if any(_is_idea(a) for a in pending):
+        return [
+            Button(text="📝 立即转为明日待办", action_payload=f"idea_to_todo:{record_id}", recommended=True),
+            Button(text="📌 保持为灵感", action_payload=f"confirm_task:{record_id}"),
+        ]
+    return [Button(text="✅ 确认创建", action_payload=f"confirm_task:{record_id}", recommended=True)]
+
+
+def _load_agent_response(supabase, record_id: Optional[str], user_id: str) -> Optional[Dict[str, Any]]:
+    """读回按钮所属消息的最终回复；只允许消息的发送者本人操作"""
+    if not record_id or supabase is None:
+        return None
+    rows = supabase.table("feishu_messages").select("sender_id, agent_response").eq("id", record_id).limit(1).execute().data
+    if not rows or rows[0]["sender_id"] != user_id:
+        return None
+    return rows[0].get("agent_response")
+
+
+def _save_agent_response(supabase, record_id: str, agent_response: Dict[str, Any]):
+    """回写动作状态与页面 ID，重复点击同一按钮不会重复创建"""
+    supabase.table("feishu_messages").update({"agent_response": agent_response}).eq("id", record_id).execute()
+
+
+def _notion_failed(result: Dict) -> bool:
+    if "error" in result:
+        print(f"[Card Action] Notion 操作失败: {result['error']}")
+        return True
+    return False
+
+# ---------------------------------------------------------------------------
+# 内置处理器
+# ---------------------------------------------------------------------------
+
+@register_action("ack_done")
+def handle_ack(manager, user_id: str, arg: Optional[str], supabase) -> ActionResult:
+    """朕已阅：只记入会话记忆，不再回复"""
+    manager.memory.add_message(user_id, "user", "[卡片操作] 朕已阅")
+    return ActionResult()
+
+
+@register_action("confirm_task")
+def handle_confirm_task(manager, user_id: str, arg: Optional[str], supabase) -> ActionResult:
+    """确认创建任务：把原消息中等待确认的 create_task 按原样写入 Notion 任务库"""
+    agent_response = _load_agent_response(supabase, arg, user_id)
+    actions = [a for a in (agent_response or {}).get("actions", [])
+               if _is_task_creation(a) and PENDING_CONFIRMATION in (a.get("next") or "")]
+    if not actions:
+        return ActionResult(reply="启禀陛下，没有待确认的任务 (可能已确认过)。")
+
+    created = []
+    for action in actions:
+        result = NotionClient.create_page(DB_CONFIG["tasks"]["id"], build_task_properties(action["data"]))
+        if _notion_failed(result):
+            break
+        action["page_id"] = result["id"]
+        action["next"] = CONFIRMED
+        created.append(action["data"].get("Task Name", ""))
+
+    if created:
+        _save_agent_response(supabase, arg, agent_response)
+        manager.memory.add_message(user_id, "user", f"[卡片操作] 确认创建: {'、'.join(created)}")
+    if len(created) < len(actions):
+        return ActionResult(reply="启禀陛下，部分任务写入 Notion 失败，请稍后再点一次确认。",
+                            buttons=[Button(text="✅ 重试确认", action_payload=f"confirm_task:{arg}", recommended=True)])
+    return ActionResult(reply=f"遵旨，已记入 Notion：{'、'.join(created)}。")
+
+
+@register_action("idea_to_todo")
+def handle_idea_to_todo(manager, user_id: str, arg: Optional[str], supabase) -> ActionResult:
+    """闪念灵感转为明日待办：灵感已入库则改写原页面，否则直接以待办创建"""
+    agent_response = _load_agent_response(supabase, arg, user_id)
+    actions = [a for a in (agent_response or {}).get("actions", [])
+               if _is_task_creation(a) and _is_idea(a) and a.get("next") != CONVERTED
+               and (PENDING_CONFIRMATION in (a.get("next") or "") or a.get("page_id"))]
+    if not actions:
+        return ActionResult(reply="启禀陛下，没有可转为待办的灵感 (可能已转过)。")
+
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+    todo = {"Type": TASK_TYPE, "Status": "Not started", "Date": tomorrow}
+    converted = []
+    for action in actions:
+        if action.get("page_id"):
+            result = NotionClient.update_page(action["page_id"], build_task_properties(todo))
+        else:
+            result = NotionClient.create_page(DB_CONFIG["tasks"]["id"], build_task_properties({**action["data"], **todo}))
+        if _notion_failed(result):
+            break
+        action["page_id"] = result["id"]
+        action["next"] = CONVERTED
+        converted.append(action["data"].get("Task Name", ""))
+
+    if converted:
+        _save_agent_response(supabase, arg, agent_response)
+        manager.memory.add_message(user_id, "user", f"[卡片操作] 灵感转为明日待办: {'、'.join(converted)}")
+    if len(converted) < len(actions):
+        return ActionResult(reply="启禀陛下，灵感转待办失败，请稍后再试。",
+                            buttons=[Button(text="📝 重试转为待办", action_payload=f"idea_to_todo:{arg}", recommended=True)])
+    return ActionResult(reply=f"诺，此灵感已转为 {tomorrow} 的待办。")
+
+
+@register_action("add_detail")
+def handle_add_detail(manager, user_id: str, arg: Optional[str], supabase) -> ActionResult:
+    """补充细节需要大总管追问，显式请求 LLM"""
+    return ActionResult(llm_message=arg or "我想补充更多细节")
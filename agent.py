@@ -9,9 +9,11 @@ import sys
 import json
 import requests
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Iterable, Iterator, Tuple
 import re
 
+from capacity_store import get_capacity_store, track_task_page
+
 # 数据库配置
 DB_CONFIG = {
     'projects': {
@@ -86,13 +88,18 @@ class NotionClient:
             'parent': {'database_id': database_id, 'type': 'database_id'},
             'properties': properties
         }
-        return NotionClient.make_request('POST', 'pages', data)
+        result = NotionClient.make_request('POST', 'pages', data)
+        # 任务库的写入同步增量更新每日容量聚合
+        track_task_page(result, DB_CONFIG['tasks']['id'])
+        return result
     
     @staticmethod
     def update_page(page_id: str, properties: Dict) -> Dict:
         """更新页面"""
         data = {'properties': properties}
-        return NotionClient.make_request('PATCH', f'pages/{page_id}', data)
+        result = NotionClient.make_request('PATCH', f'pages/{page_id}', data)
+        track_task_page(result, DB_CONFIG['tasks']['id'])
+        return result
 
 
 class TimeParser:
@@ -186,6 +193,7 @@ class TaskClassifier:
         """检测紧急程度"""
         text = text.lower()
         
+        # 与 feishu-webhook Edge Function 的 URGENT_SIGNALS 保持一致 (决定消息队列优先级)
         urgent_signals = ['急', '问题', '故障', '出事', '客户', '紧急']
         if any(signal in text for signal in urgent_signals):
             return 'P0'
@@ -202,6 +210,7 @@ class OneCompanyAgent:
         self.time_parser = TimeParser()
         self.emotion_analyzer = EmotionAnalyzer()
         self.task_classifier = TaskClassifier()
+        self.capacity = get_capacity_store()
     
     def process_message(self, message: str) -> Dict:
         """处理用户消息"""
@@ -293,6 +302,9 @@ class OneCompanyAgent:
         # 检测紧急程度
         priority = self.task_classifier.detect_urgency(message)
         
+        # 今日已排时长取自容量聚合 (O(1) 查询)
+        scheduled_hours, _ = self.capacity.get(datetime.now().strftime('%Y-%m-%d'), 'Not started')
+        
         return {
             'actions': [{
                 'type': 'create_task',
@@ -307,7 +319,7 @@ class OneCompanyAgent:
                 'next': '等待确认'
             }],
             'front_end': {
-                'coach_message': f'好的老板！我理解你要"{task_name[:30]}"，预估需要 {est_time} 小时。今天目前排了 4 小时，加上这个是 {4 + est_time} 小时，还在可控范围内。关联到 A 项目可以吗？',
+                'coach_message': f'好的老板！我理解你要"{task_name[:30]}"，预估需要 {est_time} 小时。今天目前排了 {scheduled_hours:g} 小时，加上这个是 {scheduled_hours + est_time:g} 小时，{"还在可控范围内" if scheduled_hours + est_time <= 8.0 else "已经超过 8 小时了，建议顺延部分任务"}。关联到 A 项目可以吗？',
                 'buttons': [
                     {'text': '🔴 确认创建，关联 A项目', 'recommended': True},
                     {'text': '⚪ 关联到其他项目', 'recommended': False},
@@ -330,52 +342,180 @@ class OneCompanyAgent:
             }
         }
     
-    def check_daily_capacity(self) -> Dict:
-        """检查每日容量（早晨定时任务）"""
-        today = datetime.now().strftime('%Y-%m-%d')
-        
-        # 查询今天的任务
-        result = self.notion.query_database(
-            DB_CONFIG['tasks']['id'],
-            filter={
-                'and': [
-                    {
-                        'property': 'Date',
-                        'date': {
-                            'equals': today
-                        }
-                    },
-                    {
-                        'property': 'Status',
-                        'status': {
-                            'equals': 'Not started'
-                        }
-                    }
-                ]
-            }
-        )
+    def _query_today_tasks(self, today: str) -> Dict:
+        """全量查询 Notion 中今天的任务 (用于对账)；Notion 每页最多返回 100 条，按 next_cursor 翻页取全"""
+        data = {
+            'filter': {
+                'property': 'Date',
+                'date': {
+                    'equals': today
+                }
+            },
+            'page_size': 100
+        }
+        pages = []
+        while True:
+            result = self.notion.make_request('POST', f"databases/{DB_CONFIG['tasks']['id']}/query", data)
+            if 'error' in result:
+                return result
+            pages.extend(result.get('results', []))
+            if not result.get('has_more') or not result.get('next_cursor'):
+                return {'results': pages}
+            data['start_cursor'] = result['next_cursor']
+    
+    def check_daily_capacity(self, include_tasks: bool = False) -> Dict:
+        """检查每日容量（早晨定时任务）
         
-        if 'error' in result:
-            return result
+        总时长与任务数取自增量维护的容量聚合；聚合超过 CAPACITY_RECONCILE_SECONDS 未对账，
+        或需要返回任务明细 (include_tasks) 时，才全量查询 Notion 并对账。
+        """
+        today = datetime.now().strftime('%Y-%m-%d')
+        tasks = None
         
-        tasks = result.get('results', [])
-        total_hours = 0.0
+        if include_tasks or self.capacity.needs_reconcile(today):
+            result = self._query_today_tasks(today)
+            if 'error' in result:
+                return result
+            pages = result.get('results', [])
+            self.capacity.reconcile(today, pages)
+            tasks = [p for p in pages if p.get('properties', {}).get('Status', {}).get('status', {}).get('name') == 'Not started']
         
-        for task in tasks:
-            # 提取预估时间
-            est_time_property = task.get('properties', {}).get('Est. Time', {})
-            if est_time_property.get('type') == 'number':
-                total_hours += est_time_property.get('number', 0)
+        total_hours, task_count = self.capacity.get(today, 'Not started')
         
         # 判断是否超载
         is_overloaded = total_hours > 8.0
         
-        return {
+        report = {
             'total_hours': total_hours,
             'is_overloaded': is_overloaded,
-            'task_count': len(tasks),
-            'tasks': tasks
+            'task_count': task_count
         }
+        if include_tasks:
+            report['tasks'] = tasks
+        return report
+
+
+# ---------------------------------------------------------------------------
+# 批量模式：流式读取 JSONL，进程池并行处理，适合历史聊天记录回灌与规则评估
+# ---------------------------------------------------------------------------
+
+MESSAGE_FIELDS = ('message', 'content', 'text', 'body')
+
+_bulk_agent: Optional[OneCompanyAgent] = None
+
+
+def _init_bulk_worker():
+    """进程池初始化：每个子进程只构造一次 Agent"""
+    global _bulk_agent
+    _bulk_agent = OneCompanyAgent()
+
+
+def _process_chunk(chunk: List[Tuple[int, Any, Optional[str]]]) -> List[str]:
+    """处理一批 (行号, 原始 ID, 消息)，返回序列化好的 JSONL 输出行 (在子进程内完成序列化，减少 IPC 开销)"""
+    agent = _bulk_agent or OneCompanyAgent()
+    lines = []
+    for line_no, record_id, message in chunk:
+        output = {'line': line_no, 'id': record_id}
+        if message is None:
+            output['error'] = '缺少消息字段或 JSON 解析失败'
+        else:
+            try:
+                output['result'] = agent.process_message(message)
+            except Exception as e:
+                output['error'] = str(e)
+        lines.append(json.dumps(output, ensure_ascii=False))
+    return lines
+
+
+def iter_jsonl_messages(stream, field: Optional[str] = None) -> Iterator[Tuple[int, Any, Optional[str]]]:
+    """逐行惰性读取 JSONL，产出 (行号, 原始 ID, 消息文本)；无法解析或既非对象也非字符串的行消息为 None"""
+    fields = (field,) if field else MESSAGE_FIELDS
+    for line_no, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            yield line_no, None, None
+            continue
+        if isinstance(record, str):
+            yield line_no, None, record
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None, None
+            continue
+        record_id = record.get('id', record.get('request_id'))
+        message = next((record[f] for f in fields if isinstance(record.get(f), str)), None)
+        yield line_no, record_id, message
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_bulk(input_stream, output_stream, workers: int = 1, ordered: bool = True,
+             chunk_size: int = 256, field: Optional[str] = None, report_every: float = 5.0) -> Dict:
+    """批量处理 JSONL。在途分块数有上限，输入再大内存占用也保持恒定"""
+    import time
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+    started = time.monotonic()
+    last_report = started
+    total = 0
+
+    def emit(lines: List[str]):
+        nonlocal total, last_report
+        for line in lines:
+            output_stream.write(line + '\n')
+        total += len(lines)
+        now = time.monotonic()
+        if now - last_report >= report_every:
+            last_report = now
+            print(f'[Bulk] 已处理 {total} 条，{total / (now - started):.0f} 条/秒', file=sys.stderr)
+
+    chunks = _chunked(iter_jsonl_messages(input_stream, field), chunk_size)
+
+    if workers <= 1:
+        _init_bulk_worker()
+        for chunk in chunks:
+            emit(_process_chunk(chunk))
+    else:
+        max_in_flight = workers * 2
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_bulk_worker) as executor:
+            in_flight = deque()
+            for chunk in chunks:
+                in_flight.append(executor.submit(_process_chunk, chunk))
+                while len(in_flight) >= max_in_flight:
+                    if ordered:
+                        emit(in_flight.popleft().result())
+                    else:
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            in_flight.remove(future)
+                            emit(future.result())
+            while in_flight:
+                if ordered:
+                    emit(in_flight.popleft().result())
+                else:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        in_flight.remove(future)
+                        emit(future.result())
+
+    output_stream.flush()
+    elapsed = time.monotonic() - started
+    stats = {'total': total, 'seconds': round(elapsed, 3), 'per_second': round(total / elapsed, 1) if elapsed else 0.0}
+    print(f"[Bulk] 完成：共 {stats['total']} 条，耗时 {stats['seconds']} 秒，{stats['per_second']} 条/秒", file=sys.stderr)
+    return stats
 
 
 # CLI 接口
@@ -385,14 +525,34 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='一人公司全能数字合伙人')
     parser.add_argument('message', nargs='?', help='用户消息')
     parser.add_argument('--check-capacity', action='store_true', help='检查每日容量')
+    parser.add_argument('--include-tasks', action='store_true', help='检查容量时同时返回今日任务明细 (会全量查询 Notion)')
+    parser.add_argument('--jsonl', metavar='PATH', help='批量模式：逐行处理 JSONL 文件 (- 表示标准输入)')
+    parser.add_argument('--output', metavar='PATH', default='-', help='批量模式输出 JSONL 路径 (默认标准输出)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='批量模式并行进程数')
+    parser.add_argument('--chunk-size', type=int, default=256, help='批量模式每个分块的消息条数')
+    parser.add_argument('--unordered', action='store_true', help='批量模式按完成顺序输出 (默认保持输入顺序)')
+    parser.add_argument('--field', help=f'批量模式中消息文本所在字段 (默认依次尝试 {", ".join(MESSAGE_FIELDS)})')
     
     args = parser.parse_args()
     
+    if args.jsonl:
+        input_stream = sys.stdin if args.jsonl == '-' else open(args.jsonl, 'r', encoding='utf-8')
+        output_stream = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+        try:
+            run_bulk(input_stream, output_stream, workers=args.workers, ordered=not args.unordered,
+                     chunk_size=args.chunk_size, field=args.field)
+        finally:
+            if input_stream is not sys.stdin:
+                input_stream.close()
+            if output_stream is not sys.stdout:
+                output_stream.close()
+        sys.exit(0)
+    
     agent = OneCompanyAgent()
     
     if args.check_capacity:
         # 检查每日容量
-        result = agent.check_daily_capacity()
+        result = agent.check_daily_capacity(include_tasks=args.include_tasks)
         print(json.dumps(result, indent=2, ensure_ascii=False))
     elif args.message:
         # 处理消息
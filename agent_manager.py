@@ -1,13 +1,16 @@
 import os
 import json
 import asyncio
-from typing import Dict, List, Optional, Any
+import hashlib
+import threading
+from typing import Dict, List, Optional, Any, Callable, Tuple
 from pydantic import BaseModel, Field
-from openai import AsyncOpenAI
 
 from notion_client import NotionClient
 from memory_manager import MemoryManager
 from tools import TOOLS_SCHEMA, AVAILABLE_TOOLS_MAP, execute_tool_call
+from model_tiering import estimate_complexity, select_tier, validate_reply
+from usage_tracker import UsageTracker, QuotaExceededError, QUOTA_DEFER, QUOTA_DOWNGRADE
 
 # ---------------------------------------------------------------------------
 # 1. 定义 Pydantic 数据模型，约束 LLM 输出格式
@@ -28,6 +31,9 @@ class Action(BaseModel):
     data: Dict[str, Any] = Field(description="具体的属性键值对")
     next: Optional[str] = Field(None, description="后续的动作说明，例如 '等待确认'")
 
+# Action.next 含该标记的动作需老板在飞书卡片上确认，完成路径不直接执行 (见 action_handlers.confirmation_buttons)
+PENDING_CONFIRMATION = "等待确认"
+
 class AgentResponse(BaseModel):
     actions: List[Action] = Field(default_factory=list, description="需要在 Notion 中执行的动作列表")
     front_end: FrontEnd = Field(description="需要发送给老板的飞书卡片内容")
@@ -45,6 +51,123 @@ class RouterPlan(BaseModel):
     delegations: List[Delegation] = Field(default_factory=list, description="需要分发给各个尚书的业务需求")
     direct_reply: Optional[str] = Field(None, description="如果无需分发业务，直接向老板的汇报或问候的话术")
 
+# ---------------------------------------------------------------------------
+# Router 流式输出的增量解析 (边生成边分发 Delegation)
+# ---------------------------------------------------------------------------
+
+class DelegationStreamParser:
+    """增量扫描 RouterPlan 的 JSON 文本，每当 delegations 数组中的一个对象闭合即产出 Delegation"""
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0               # 已扫描到的位置
+        self._depth = 0             # 当前花括号/方括号嵌套深度
+        self._in_string = False
+        self._escape = False
+        self._array_depth = None    # delegations 数组 "[" 所在深度
+        self._object_start = None   # 当前 Delegation 对象在 buffer 中的起点
+        self._last_key = None       # 最近一次闭合的字符串 (用于识别 "delegations" 键)
+        self._string_start = None
+
+    def feed(self, chunk: str) -> List[Delegation]:
+        """喂入一段增量文本，返回本次新完成的 Delegation 列表"""
+        self.buffer += chunk
+        completed: List[Delegation] = []
+        text = self.buffer
+
+        while self._pos < len(text):
+            ch = text[self._pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_key = text[self._string_start:self._pos]
+                self._pos += 1
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = self._pos + 1
+            elif ch in "{[":
+                self._depth += 1
+                if ch == "[" and self._array_depth is None and self._depth == 2 and self._last_key == "delegations":
+                    self._array_depth = self._depth
+                elif ch == "{" and self._array_depth is not None and self._depth == self._array_depth + 1:
+                    self._object_start = self._pos
+            elif ch in "}]":
+                if ch == "}" and self._object_start is not None and self._depth == self._array_depth + 1:
+                    raw = text[self._object_start:self._pos + 1]
+                    self._object_start = None
+                    try:
+                        completed.append(Delegation(**json.loads(raw)))
+                    except Exception as e:
+                        # 解析失败不影响主流程，最终以完整 RouterPlan 为准补发
+                        print(f"[Router Stream] 增量解析 Delegation 失败: {e}")
+                elif ch == "]" and self._array_depth is not None and self._depth == self._array_depth:
+                    self._array_depth = -1  # delegations 数组已结束，不再匹配
+                self._depth -= 1
+            elif ch not in " \t\r\n:,":
+                # 出现非字符串的值 (数字/布尔/null)，清空最近的键
+                self._last_key = None
+
+            self._pos += 1
+
+        return completed
+
+# ---------------------------------------------------------------------------
+# 处理检查点：RouterPlan 与各部门结果完成即持久化，失败重试时从最后完成的阶段续跑
+# ---------------------------------------------------------------------------
+
+class MessageCheckpoint:
+    """单条消息的处理检查点。持久化由调用方通过 on_plan / on_result 回调实现 (如写回 feishu_messages)"""
+
+    def __init__(self, plan: Optional[RouterPlan] = None, results: Optional[Dict[int, str]] = None,
+                 on_plan=None, on_result=None):
+        self.plan = plan
+        self.results: Dict[int, str] = dict(results or {})
+        self._on_plan = on_plan
+        self._on_result = on_result
+
+    def save_plan(self, plan: RouterPlan):
+        self.plan = plan
+        if self._on_plan:
+            self._on_plan(plan)
+
+    def save_result(self, index: int, result: str):
+        self.results[index] = result
+        if self._on_result:
+            self._on_result(self.results)
+
+# ---------------------------------------------------------------------------
+# Prompt 缓存命中统计 (按 agent + prompt 版本聚合 usage.prompt_tokens_details.cached_tokens)
+# ---------------------------------------------------------------------------
+
+class PromptCacheStats:
+    def __init__(self):
+        self.stats: Dict[str, Dict[str, int]] = {}
+        # 可选回调 listener(agent_name, prompt_tokens, cached_tokens)，worker 用它把计数导出到 supervisor 的 /metrics
+        self.listener: Optional[Callable[[str, int, int], None]] = None
+
+    def record(self, agent_name: str, prompt_version: str, usage) -> None:
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+        key = f"{agent_name}@{prompt_version or 'none'}"
+        entry = self.stats.setdefault(key, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        entry["calls"] += 1
+        entry["prompt_tokens"] += prompt_tokens
+        entry["cached_tokens"] += cached_tokens
+        print(f"[Prompt Cache] {key} 命中 {cached_tokens}/{prompt_tokens} tokens")
+        if self.listener:
+            self.listener(agent_name, prompt_tokens, cached_tokens)
+
 # ---------------------------------------------------------------------------
 # 2. 从配置文件加载 Agents
 # ---------------------------------------------------------------------------
@@ -65,53 +188,133 @@ class CabinetManager:
     """虚拟内阁大总管 (Multi-Agent Supervisor Routing, 支持 Async、Memory、Tools)"""
     
     def __init__(self):
-        self.notion = NotionClient()
         self.agents_config = load_agents_config()
-        self.memory = MemoryManager(max_history_per_user=10)
+        # 超限时成批裁剪历史，让历史前缀在多轮对话间保持稳定，提高 Prompt 缓存命中率
+        self.memory = MemoryManager(max_history_per_user=10, trim_step=4)
+        # Prompt 文件缓存 (按 mtime 失效，保留热更新) 与缓存命中统计
+        self._prompt_cache: Dict[str, Any] = {}
+        self.prompt_cache_stats = PromptCacheStats()
+        # 按 用户/部门/模型 记录 Token 与费用，分发前做配额检查
+        self.usage = UsageTracker(model_prices=self._model_prices())
         
-        # 改用 AsyncOpenAI 支持并发
-        self.client = AsyncOpenAI(
-            api_key=os.environ.get("OPENAI_API_KEY", "your-openai-api-key"),
-            base_url=os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
-        )
+        # OpenAI / Notion 客户端延迟构造：冷启动不导入 openai，由 warm_up() 或首次调用时创建
+        self._client = None
+        self._notion = None
+        self._client_lock = threading.Lock()
         self.router_model = self.agents_config.get("router", {}).get("model", "gpt-4o-2024-08-06")
+        # 流式解析 RouterPlan，Delegation 一旦完整即提前派发 (可在配置中关闭)
+        self.speculative_dispatch = self.agents_config.get("router", {}).get("speculative_dispatch", True)
 
-    def _get_prompt(self, agent_name: str) -> str:
+    @property
+    def client(self):
+        # 改用 AsyncOpenAI 支持并发
+        with self._client_lock:
+            if self._client is None:
+                from openai import AsyncOpenAI
+                self._client = AsyncOpenAI(
+                    api_key=os.environ.get("OPENAI_API_KEY", "your-openai-api-key"),
+                    base_url=os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+                )
+            return self._client
+
+    @property
+    def notion(self) -> NotionClient:
+        if self._notion is None:
+            self._notion = NotionClient()
+        return self._notion
+
+    async def warm_up(self, timeout: float = 5.0):
+        """预热：在线程中导入并构造客户端、预读全部 Prompt，再预先建立到 OpenAI 与 Notion 的连接，消除首个请求的握手开销"""
+        def prepare():
+            for agent_name in self.agents_config:
+                self._load_prompt(agent_name)
+            return self.client
+
+        client = await asyncio.to_thread(prepare)
+
+        async def ping_openai():
+            try:
+                await client.with_options(max_retries=0, timeout=timeout).models.list()
+            except Exception as e:
+                print(f"[Warm-up] OpenAI 连接预热失败: {e}")
+
+        await asyncio.gather(ping_openai(), asyncio.to_thread(NotionClient.warm_up, timeout))
+
+    def _load_prompt(self, agent_name: str):
+        """读取 Prompt 文件并计算版本哈希；文件未修改时直接复用缓存"""
         prompt_file = self.agents_config.get(agent_name, {}).get("prompt_file")
         if not prompt_file:
-            return ""
+            return "", ""
         prompt_path = os.path.join(os.path.dirname(__file__), prompt_file)
-        if os.path.exists(prompt_path):
-            with open(prompt_path, "r", encoding="utf-8") as f:
-                return f.read()
-        return ""
+        if not os.path.exists(prompt_path):
+            return "", ""
 
-    async def _call_sub_agent(self, agent_name: str, task_desc: str, user_id: str) -> str:
-        """异步调用单个部门，支持 Function Calling 循环"""
-        agent_model = self.agents_config.get(agent_name, {}).get("model", "gpt-4o-2024-08-06")
-        agent_prompt = self._get_prompt(agent_name)
-        
-        print(f"[{agent_name}] 接收任务开始处理...")
-        
-        # 1. 组装历史上下文 (这里只让 Worker 知道当前的 Task，不混入整个聊天的历史，以此保持专注)
+        mtime = os.path.getmtime(prompt_path)
+        cached = self._prompt_cache.get(agent_name)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+
+        with open(prompt_path, "r", encoding="utf-8") as f:
+            content = f.read()
+        version = hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+        self._prompt_cache[agent_name] = (mtime, content, version)
+        return content, version
+
+    def _get_prompt(self, agent_name: str) -> str:
+        return self._load_prompt(agent_name)[0]
+
+    def _prompt_version(self, agent_name: str) -> str:
+        return self._load_prompt(agent_name)[1]
+
+    def _model_prices(self) -> Dict[str, float]:
+        """从各部门 tiers 中收集 model -> 每千 Token 单价，用于费用核算"""
+        prices = {}
+        for agent_config in self.agents_config.values():
+            for tier in agent_config.get("tiers", []):
+                if "cost_per_1k_tokens" in tier:
+                    prices[tier["model"]] = tier["cost_per_1k_tokens"]
+        return prices
+
+    def _record_usage(self, agent_name: str, agent_model: str, user_id: str, usage) -> None:
+        self.prompt_cache_stats.record(agent_name, self._prompt_version(agent_name), usage)
+        try:
+            self.usage.record(user_id, agent_name, agent_model, usage)
+        except Exception as e:
+            # 用量记录失败不影响回复
+            print(f"[Usage] 记录用量失败: {e}")
+
+    def _check_quota(self, user_id: str) -> None:
+        """Router 与部门分发前的配额闸门：超出硬上限的用户直接延后处理"""
+        if self.usage.check_quota(user_id) == QUOTA_DEFER:
+            raise QuotaExceededError(user_id, self.usage.defer_seconds)
+
+    def _get_agent_tiers(self, agent_name: str) -> List[Dict[str, Any]]:
+        """部门的模型档位 (由便宜到强)；未配置 tiers 时退化为单一 model"""
+        agent_config = self.agents_config.get(agent_name, {})
+        return agent_config.get("tiers") or [{"model": agent_config.get("model", "gpt-4o-2024-08-06")}]
+
+    def _select_tier(self, agent_name: str, task_desc: str, user_id: Optional[str] = None):
+        """按任务复杂度挑选起始档位，返回 (tiers, 档位下标)；接近配额的用户固定使用最便宜档位且不再升级"""
+        tiers = self._get_agent_tiers(agent_name)
+        if user_id and len(tiers) > 1 and self.usage.check_quota(user_id) == QUOTA_DOWNGRADE:
+            print(f"[{agent_name}] 用户 {user_id} 用量接近配额，降级使用 {tiers[0]['model']}")
+            return tiers[:1], 0
+        complexity = estimate_complexity(task_desc)
+        index = select_tier(tiers, complexity)
+        print(f"[{agent_name}] 任务复杂度 {complexity}，选用 {tiers[index]['model']}")
+        return tiers, index
+
+    def _build_sub_agent_messages(self, agent_name: str, task_desc: str) -> List[Dict[str, Any]]:
+        # 组装历史上下文 (这里只让 Worker 知道当前的 Task，不混入整个聊天的历史，以此保持专注)
         # 如果需要共享记忆，可将 self.memory.get_history(user_id) 传入。
-        messages = [
-            {"role": "system", "content": agent_prompt},
+        return [
+            {"role": "system", "content": self._get_prompt(agent_name)},
             {"role": "user", "content": task_desc}
         ]
 
-        # 2. 调用 LLM 并提供 Tools
-        response = await self.client.chat.completions.create(
-            model=agent_model,
-            messages=messages,
-            tools=TOOLS_SCHEMA,
-            tool_choice="auto"
-        )
-        
-        first_choice = response.choices[0]
-        message = first_choice.message
-        
-        # 3. 判断是否需要使用工具
+    async def _finish_sub_agent(self, agent_name: str, agent_model: str, messages: List[Any], message,
+                                user_id: str) -> Optional[str]:
+        """根据部门的首轮回复收尾：如触发 Tool Call 则本地执行工具并再次调用大模型，返回最终回复原文"""
         if message.tool_calls:
             print(f"[{agent_name}] 触发 Tool Call")
             messages.append(message)  # 必须将返回的 tool_calls 对象追加进对话
@@ -132,53 +335,223 @@ class CabinetManager:
                 model=agent_model,
                 messages=messages
             )
-            final_reply = second_response.choices[0].message.content
-        else:
-            final_reply = message.content
+            self._record_usage(agent_name, agent_model, user_id, second_response.usage)
+            return second_response.choices[0].message.content
 
-        print(f"[{agent_name}] 任务处理完成！")
+        return message.content
+
+    @staticmethod
+    def _format_sub_result(agent_name: str, final_reply: str) -> str:
         return f"【处理人：{agent_name} 部门】\n{final_reply}"
 
+    async def _call_sub_agent_with_model(self, agent_name: str, agent_model: str, task_desc: str,
+                                         user_id: str) -> Optional[str]:
+        """用指定模型调用一次部门，支持 Function Calling 循环，返回回复原文"""
+        # 1. 组装上下文
+        messages = self._build_sub_agent_messages(agent_name, task_desc)
 
-    async def process_message(self, message: str, user_id: str = "default_boss") -> Optional[AgentResponse]:
-        """主入口：处理意图，并行分发，并调用工具。"""
-        
-        from datetime import datetime
-        current_context = f"\n[System Context] 当前系统时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        router_prompt = self._get_prompt("router") + current_context
+        # 2. 调用 LLM 并提供 Tools
+        response = await self.client.chat.completions.create(
+            model=agent_model,
+            messages=messages,
+            tools=TOOLS_SCHEMA,
+            tool_choice="auto"
+        )
+        self._record_usage(agent_name, agent_model, user_id, response.usage)
         
-        # 将用户新消息加入 Router 长记忆
-        self.memory.add_message(user_id, "user", message)
-        history_messages = self.memory.get_history(user_id)
+        # 3. 判断是否需要使用工具并收尾
+        return await self._finish_sub_agent(agent_name, agent_model, messages, response.choices[0].message, user_id)
+
+    async def _escalate_sub_agent(self, agent_name: str, task_desc: str, user_id: str, tiers: List[Dict[str, Any]],
+                                  start: int, reply: Optional[str] = None) -> str:
+        """从 start 档位开始逐级调用，回复未通过校验则升级到更强的模型；reply 为已拿到的 start 档位回复"""
+        for index in range(start, len(tiers)):
+            agent_model = tiers[index]["model"]
+            if reply is None:
+                reply = await self._call_sub_agent_with_model(agent_name, agent_model, task_desc, user_id)
+            if validate_reply(reply) or index == len(tiers) - 1:
+                break
+            print(f"[{agent_name}] {agent_model} 回复未通过校验，升级到 {tiers[index + 1]['model']}")
+            reply = None
+
+        print(f"[{agent_name}] 任务处理完成！")
+        return self._format_sub_result(agent_name, reply)
+
+    async def _call_sub_agent(self, agent_name: str, task_desc: str, user_id: str) -> str:
+        """异步调用单个部门：按复杂度选择模型档位，必要时逐级升级"""
+        print(f"[{agent_name}] 接收任务开始处理...")
+        tiers, start = self._select_tier(agent_name, task_desc, user_id)
+        return await self._escalate_sub_agent(agent_name, task_desc, user_id, tiers, start)
+
+    async def _run_delegation(self, index: int, delegation: Delegation, user_id: str,
+                              checkpoint: Optional["MessageCheckpoint"] = None) -> str:
+        """执行单个部门任务；检查点中已有结果则直接复用，完成后立即落盘"""
+        if checkpoint and index in checkpoint.results:
+            print(f"[{delegation.agent_name}] 命中检查点，跳过重复调用")
+            return checkpoint.results[index]
+
+        result = await self._call_sub_agent(delegation.agent_name, delegation.task_description, user_id)
+        if checkpoint:
+            checkpoint.save_result(index, result)
+        return result
+
+    async def _route_and_dispatch_streaming(self, messages: List[Dict[str, Any]], user_id: str,
+                                            checkpoint: Optional["MessageCheckpoint"] = None):
+        """流式获取 RouterPlan，每解析出一个 Delegation 立即派发子部门，与 Router 剩余生成过程重叠
+
+        提前派发的任务按 (agent_name, task_description) 与完整 RouterPlan 逐条对齐后才落盘检查点：
+        增量解析失败导致的错位不会让某个部门漏跑、重跑或结果记到别的部门名下。
+        Router 拒答 (parsed 为空) 时返回 (None, [])。
+        """
+        parser = DelegationStreamParser()
+        speculative: List[Tuple[Delegation, asyncio.Task]] = []
+
+        def dispatch(delegation: Delegation):
+            print(f"[Router Stream] 提前分发 -> {delegation.agent_name}")
+            speculative.append((delegation, asyncio.create_task(
+                self._call_sub_agent(delegation.agent_name, delegation.task_description, user_id)
+            )))
+
+        async def adopt(index: int, task: asyncio.Task) -> str:
+            result = await task
+            if checkpoint:
+                checkpoint.save_result(index, result)
+            return result
+
+        try:
+            async with self.client.beta.chat.completions.stream(
+                model=self.router_model,
+                messages=messages,
+                response_format=RouterPlan,
+                stream_options={"include_usage": True},
+            ) as stream:
+                async for event in stream:
+                    if event.type == "content.delta":
+                        for delegation in parser.feed(event.delta):
+                            dispatch(delegation)
+                final_completion = await stream.get_final_completion()
+
+            plan: Optional[RouterPlan] = final_completion.choices[0].message.parsed
+            self._record_usage("router", self.router_model, user_id, final_completion.usage)
+            if plan is None:
+                print(f"[Router 计划] Router 未返回有效计划 (拒答: {final_completion.choices[0].message.refusal})")
+                for _, task in speculative:
+                    task.cancel()
+                return None, []
+
+            print(f"[Router 计划] 需分发任务数: {len(plan.delegations)}, 直接Notion动作数: {len(plan.direct_actions)} (已提前分发 {len(speculative)})")
+            if checkpoint:
+                checkpoint.save_plan(plan)
+
+            # 以完整 RouterPlan 为准：逐条认领内容相同的提前派发任务，缺少的补发，多余的取消
+            unmatched = list(speculative)
+            jobs = []
+            for index, delegation in enumerate(plan.delegations):
+                key = (delegation.agent_name, delegation.task_description)
+                match = next((i for i, (d, _) in enumerate(unmatched) if (d.agent_name, d.task_description) == key), None)
+                if match is None:
+                    jobs.append(self._run_delegation(index, delegation, user_id, checkpoint))
+                else:
+                    jobs.append(adopt(index, unmatched.pop(match)[1]))
+            for delegation, task in unmatched:
+                print(f"[Router Stream] 提前分发的 {delegation.agent_name} 任务不在最终计划中，已取消")
+                task.cancel()
+        except BaseException:
+            # Router 失败时取消已提前派发的子任务，避免孤儿请求
+            for _, task in speculative:
+                task.cancel()
+            raise
+
+        sub_results = await asyncio.gather(*jobs) if jobs else []
+        return plan, list(sub_results)
+
+    def _build_router_messages(self, message: str, user_id: str) -> List[Dict[str, Any]]:
+        """组装发送给大总管的完整消息体 (历史 + 用户新消息)
+
+        只读取长记忆、不写入：本轮对话在 _assemble_response 中才整体写入，失败重试不会重复追加用户消息。
+        消息布局按 Prompt 缓存友好的顺序排列：静态 Prompt -> 稳定的历史记录 -> 易变上下文 (时间)。
+        前两段在多次调用间保持字节级一致，才能命中服务端的前缀缓存。
+        """
+        history_messages = self.memory.get_history(user_id) + [{"role": "user", "content": message}]
         
         # 组装完整的消息体发送给大总管
-        messages = [{"role": "system", "content": router_prompt}] + history_messages
-        
-        print("[Router] 正在获取记忆，解析陛下意图...")
-        router_response = await self.client.beta.chat.completions.parse(
-            model=self.router_model,
-            messages=messages,
-            response_format=RouterPlan,
+        return (
+            [{"role": "system", "content": self._get_prompt("router")}]
+            + history_messages
+            + [{"role": "system", "content": self._volatile_context()}]
         )
+
+    @staticmethod
+    def _volatile_context() -> str:
+        """易变上下文放在消息末尾，时间按 ROUTER_TIME_GRANULARITY_MINUTES 向下取整"""
+        from datetime import datetime
+        granularity = max(1, int(os.environ.get("ROUTER_TIME_GRANULARITY_MINUTES", "5")))
+        now = datetime.now()
+        now = now.replace(minute=now.minute - now.minute % granularity, second=0, microsecond=0)
+        return f"[System Context] 当前系统时间: {now.strftime('%Y-%m-%d %H:%M')}"
+
+    async def process_message(self, message: str, user_id: str = "default_boss",
+                              checkpoint: Optional["MessageCheckpoint"] = None) -> Optional[AgentResponse]:
+        """主入口：处理意图，并行分发，并调用工具。
+
+        传入 checkpoint 时，RouterPlan 与各部门结果在完成时即持久化；重试时已完成的阶段直接复用。
+        用户超出配额时抛出 QuotaExceededError，由调用方延后重排。
+        """
+        self._check_quota(user_id)
         
-        plan: RouterPlan = router_response.choices[0].message.parsed
-        print(f"[Router 计划] 需分发任务数: {len(plan.delegations)}, 直接Notion动作数: {len(plan.direct_actions)}")
-
-        # ---------------------------------------------------------
-        # 大幅优化：使用 Asyncio 并发调用子部门 (Workers)
-        # ---------------------------------------------------------
-        tasks = []
-        for delegation in plan.delegations:
-            # 将分发的任务推入 async 任务列表，准备并发执行
-            task = self._call_sub_agent(delegation.agent_name, delegation.task_description, user_id)
-            tasks.append(task)
-            
-        # 并发执行并等待所有结果返回 (时间将取决于最慢的那个响应)
-        sub_results = await asyncio.gather(*tasks) if tasks else []
+        if checkpoint and checkpoint.plan:
+            # 断点续跑：跳过 Router，只补跑尚未完成的部门
+            plan = checkpoint.plan
+            print(f"[Router] 命中检查点，复用 RouterPlan (已完成部门 {len(checkpoint.results)}/{len(plan.delegations)})")
+            sub_results = await asyncio.gather(*(
+                self._run_delegation(index, delegation, user_id, checkpoint)
+                for index, delegation in enumerate(plan.delegations)
+            )) if plan.delegations else []
+            return self._assemble_response(plan, list(sub_results), user_id, message)
 
-        # ---------------------------------------------------------
-        # 大总管汇总与组装飞书卡片返回格式
-        # ---------------------------------------------------------
+        if checkpoint:
+            # 没有 RouterPlan 的部门结果无法对应到新计划，作废重来
+            checkpoint.results.clear()
+
+        messages = self._build_router_messages(message, user_id)
+        
+        print("[Router] 正在获取记忆，解析陛下意图...")
+        if self.speculative_dispatch:
+            plan, sub_results = await self._route_and_dispatch_streaming(messages, user_id, checkpoint)
+            if plan is None:
+                return None
+        else:
+            router_response = await self.client.beta.chat.completions.parse(
+                model=self.router_model,
+                messages=messages,
+                response_format=RouterPlan,
+            )
+
+            plan: Optional[RouterPlan] = router_response.choices[0].message.parsed
+            self._record_usage("router", self.router_model, user_id, router_response.usage)
+            if plan is None:
+                print(f"[Router 计划] Router 未返回有效计划 (拒答: {router_response.choices[0].message.refusal})")
+                return None
+            print(f"[Router 计划] 需分发任务数: {len(plan.delegations)}, 直接Notion动作数: {len(plan.direct_actions)}")
+            if checkpoint:
+                checkpoint.save_plan(plan)
+
+            # ---------------------------------------------------------
+            # 大幅优化：使用 Asyncio 并发调用子部门 (Workers)
+            # ---------------------------------------------------------
+            tasks = []
+            for index, delegation in enumerate(plan.delegations):
+                # 将分发的任务推入 async 任务列表，准备并发执行
+                task = self._run_delegation(index, delegation, user_id, checkpoint)
+                tasks.append(task)
+
+            # 并发执行并等待所有结果返回 (时间将取决于最慢的那个响应)
+            sub_results = await asyncio.gather(*tasks) if tasks else []
+
+        return self._assemble_response(plan, sub_results, user_id, message)
+
+    def _assemble_response(self, plan: RouterPlan, sub_results: List[str], user_id: str, message: str) -> AgentResponse:
+        """大总管汇总与组装飞书卡片返回格式，并把本轮 (用户消息 + 合并答复) 写入会话记忆"""
         print("[Router] 正在组装前端卡片...")
         coach_msg = ""
         
@@ -193,7 +566,8 @@ class CabinetManager:
         if not coach_msg.strip():
             coach_msg = "陛下，查无相关指令回执。"
             
-        # 将大总管的最终合并答复存入历史记录，供下一次对话追溯
+        # 本轮完成后才把用户消息与大总管的最终合并答复一起存入历史记录，供下一次对话追溯
+        self.memory.add_message(user_id, "user", message)
         self.memory.add_message(user_id, "assistant", coach_msg.strip())
             
         front_end = FrontEnd(
@@ -206,6 +580,9 @@ class CabinetManager:
     async def execute_actions(self, actions: List[Action]):
         """执行大总管在 Notion 的动作 (保持同步，也可使用线程池，但动作一般较快)"""
         for action in actions:
+            if PENDING_CONFIRMATION in (action.next or ""):
+                print(f"[Notion Action] {action.type} 等待飞书按钮确认，暂不执行")
+                continue
             print(f"[Notion Action] 类型: {action.type}, 数据库: {action.database}")
             print(f"[Notion Data] {json.dumps(action.data, ensure_ascii=False, indent=2)}")
             # ... 实际通过 self.notion 操作
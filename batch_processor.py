@@ -0,0 +1,382 @@
+import os
+import json
+import uuid
+import time
+import asyncio
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Any, Callable, Awaitable
+
+from agent_manager import CabinetManager, RouterPlan, AgentResponse
+from usage_tracker import QuotaExceededError
+from tools import TOOLS_SCHEMA
+
+# ---------------------------------------------------------------------------
+# 积压模式 (Backlog Mode)：故障恢复后大量 pending 消息改走 OpenAI Batch API
+# 两段式流水线：先批量跑 Router，再把所有 Delegation 合并成第二个批次跑各部门，
+# 最终结果回流到 worker 的常规完成路径 (执行 Notion 动作 -> 回复飞书 -> completed)
+# ---------------------------------------------------------------------------
+
+BATCH_QUEUE_DEPTH = int(os.environ.get("BATCH_QUEUE_DEPTH", "50"))              # pending 数超过该值进入积压模式
+BATCH_MAX_AGE_SECONDS = int(os.environ.get("BATCH_MAX_AGE_SECONDS", "600"))     # 最老 pending 消息超过该秒数进入积压模式
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "500"))                   # 单个批次最多包含的消息数
+BATCH_POLL_INTERVAL = int(os.environ.get("BATCH_POLL_INTERVAL", "30"))          # 轮询批次状态/检查积压的间隔 (秒)
+
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+
+
+class OpenAIBatchBackend:
+    """基于 OpenAI Batch API 的批处理后端 (半价计费，24h 完成窗口)"""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def submit(self, requests: List[Dict[str, Any]]) -> str:
+        lines = "\n".join(json.dumps(req, ensure_ascii=False) for req in requests)
+        batch_file = await self.client.files.create(
+            file=("batch_input.jsonl", lines.encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=CHAT_COMPLETIONS_ENDPOINT,
+            completion_window="24h"
+        )
+        return batch.id
+
+    async def poll(self, job_id: str) -> str:
+        batch = await self.client.batches.retrieve(job_id)
+        if batch.status in ("validating", "in_progress", "finalizing"):
+            return "in_progress"
+        if batch.status == "completed":
+            return "completed"
+        return "failed"
+
+    async def results(self, job_id: str) -> Dict[str, Optional[Dict[str, Any]]]:
+        """返回 custom_id -> ChatCompletion 响应体 (失败的请求为 None)"""
+        batch = await self.client.batches.retrieve(job_id)
+        results: Dict[str, Optional[Dict[str, Any]]] = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await self.client.files.content(file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                ok = response.get("status_code") == 200 and not item.get("error")
+                results[item["custom_id"]] = response.get("body") if ok else None
+        return results
+
+
+class LocalBatchBackend:
+    """本地批处理替身：接口与 OpenAIBatchBackend 一致，提交后立即在后台逐条执行
+
+    可传入 responder(body) -> dict 替代真实请求，便于在无网络/无 Batch 权限的环境下演练整条积压流水线。
+    """
+
+    def __init__(self, client=None, responder: Optional[Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]] = None, concurrency: int = 8):
+        self.client = client
+        self.responder = responder
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+
+    async def _run_one(self, body: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        async with self.semaphore:
+            try:
+                if self.responder:
+                    return await self.responder(body)
+                response = await self.client.chat.completions.create(**body)
+                return response.model_dump()
+            except Exception as e:
+                print(f"[Local Batch] 请求失败: {e}")
+                return None
+
+    async def _run_job(self, job_id: str, requests: List[Dict[str, Any]]):
+        outputs = await asyncio.gather(*(self._run_one(req["body"]) for req in requests))
+        job = self.jobs[job_id]
+        job["results"] = {req["custom_id"]: out for req, out in zip(requests, outputs)}
+        job["status"] = "completed"
+
+    async def submit(self, requests: List[Dict[str, Any]]) -> str:
+        job_id = f"local_batch_{uuid.uuid4().hex[:12]}"
+        self.jobs[job_id] = {"status": "in_progress", "results": {}}
+        self.jobs[job_id]["task"] = asyncio.create_task(self._run_job(job_id, requests))
+        return job_id
+
+    async def poll(self, job_id: str) -> str:
+        job = self.jobs.get(job_id)
+        # 进程重启后本地批次丢失，按失败处理让消息回退到交互路径
+        return job["status"] if job else "failed"
+
+    async def results(self, job_id: str) -> Dict[str, Optional[Dict[str, Any]]]:
+        return self.jobs[job_id]["results"]
+
+
+def create_batch_backend(manager: CabinetManager):
+    """按环境变量 BATCH_BACKEND (openai / local) 创建批处理后端"""
+    if os.environ.get("BATCH_BACKEND", "openai") == "local":
+        return LocalBatchBackend(client=manager.client)
+    return OpenAIBatchBackend(manager.client)
+
+
+def _parse_created_at(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class BatchCoordinator:
+    """积压模式调度器：判断是否进入积压模式、提交批次、跟踪 batch_jobs 状态并回流结果"""
+
+    def __init__(self, supabase, manager: CabinetManager,
+                 on_complete: Callable[[Dict[str, Any], AgentResponse], Awaitable[None]],
+                 backend=None,
+                 on_failure: Optional[Callable[[Dict[str, Any], Exception], None]] = None,
+                 on_defer: Optional[Callable[[Dict[str, Any], QuotaExceededError], None]] = None):
+        self.supabase = supabase
+        self.manager = manager
+        self.on_complete = on_complete
+        # 单条消息处理失败时的回调 (worker 传入 handle_failure 计入重试次数)；未提供时直接退回 pending
+        self.on_failure = on_failure
+        # 用户超出配额时的回调 (worker 传入 defer_record 降低优先级并延后)；未提供时留在 pending 等待下一轮
+        self.on_defer = on_defer
+        self._backend = backend
+        self._last_tick = 0.0
+
+    @property
+    def backend(self):
+        """批处理后端在首次提交或轮询批次时才创建，不拖慢 Worker 冷启动"""
+        if self._backend is None:
+            self._backend = create_batch_backend(self.manager)
+        return self._backend
+
+    # -------------------------- 触发判断 --------------------------
+
+    def backlog_detected(self) -> bool:
+        """可认领的 pending 队列深度或最老消息年龄超过阈值时进入积压模式
+
+        被延后 (not_before 未到) 或排在同一用户进行中消息之后的行不计入，见 schema.sql 中的 feishu_backlog_stats。
+        """
+        rows = self.supabase.rpc("feishu_backlog_stats", {}).execute().data or []
+        stats = rows[0] if rows else {}
+        depth = stats.get("depth") or 0
+        if depth >= BATCH_QUEUE_DEPTH:
+            print(f"[Backlog] 待处理消息 {depth} 条，超过阈值 {BATCH_QUEUE_DEPTH}，进入积压模式")
+            return True
+        if depth == 0 or not stats.get("oldest_created_at"):
+            return False
+
+        age = (datetime.now(timezone.utc) - _parse_created_at(stats["oldest_created_at"])).total_seconds()
+        if age >= BATCH_MAX_AGE_SECONDS:
+            print(f"[Backlog] 最老消息已等待 {int(age)} 秒，超过阈值 {BATCH_MAX_AGE_SECONDS}，进入积压模式")
+            return True
+        return False
+
+    async def tick(self):
+        """按间隔推进已有批次，并在积压时提交新的 Router 批次"""
+        if time.monotonic() - self._last_tick < BATCH_POLL_INTERVAL:
+            return
+        self._last_tick = time.monotonic()
+
+        await self.poll_jobs()
+        if self.backlog_detected():
+            await self.submit_router_batch()
+
+    async def run(self):
+        """作为 worker 的独立后台任务运行：回流大批次结果可能耗时数分钟，不能阻塞交互认领循环与心跳"""
+        print("📦 启动积压模式调度器...")
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"[Backlog] 调度循环发生异常: {e}")
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+    # -------------------------- 第一段：Router --------------------------
+
+    def _router_request(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        # 只读取会话历史：本轮对话在结果回流完成时由 _assemble_response 写入记忆
+        messages = self.manager._build_router_messages(record["content"], record["sender_id"])
+        return {
+            "custom_id": record["id"],
+            "method": "POST",
+            "url": CHAT_COMPLETIONS_ENDPOINT,
+            "body": {
+                "model": self.manager.router_model,
+                "messages": messages,
+                "response_format": {
+                    "type": "json_schema",
+                    "json_schema": {"name": "RouterPlan", "schema": RouterPlan.model_json_schema()}
+                }
+            }
+        }
+
+    async def submit_router_batch(self):
+        # 原子认领并标记 batched (逐用户串行规则与交互认领一致，not_before 未到的行跳过)，
+        # 上传批次文件期间这些行不会再被任何进程的交互认领取走
+        response = self.supabase.rpc("claim_feishu_messages_for_batch", {"p_limit": BATCH_MAX_SIZE}).execute()
+        records = []
+        for record in response.data or []:
+            # 与交互路径一致：超出配额的用户不进入批次
+            try:
+                self.manager._check_quota(record["sender_id"])
+            except QuotaExceededError as e:
+                if self.on_defer:
+                    self.on_defer(record, e)
+                else:
+                    self._release([record["id"]])
+                continue
+            records.append(record)
+        if not records:
+            return
+
+        record_ids = [record["id"] for record in records]
+        try:
+            requests = [self._router_request(record) for record in records]
+            provider_job_id = await self.backend.submit(requests)
+        except Exception:
+            # 提交失败：退回 pending，由交互路径或下一轮批次重新处理
+            self._release(record_ids)
+            raise
+
+        job = self.supabase.table("batch_jobs").insert({
+            "provider_job_id": provider_job_id,
+            "stage": "router",
+            "status": "in_progress",
+            "record_ids": record_ids,
+            "payload": {}
+        }).execute().data[0]
+        self.supabase.table("feishu_messages").update({"batch_job_id": job["id"]}).in_("id", record_ids).execute()
+        print(f"📦 [Backlog] 已提交 Router 批次 {provider_job_id}，包含 {len(records)} 条消息")
+
+    async def _handle_router_results(self, job: Dict[str, Any], records: Dict[str, Dict[str, Any]], results: Dict[str, Optional[Dict[str, Any]]]):
+        plans: Dict[str, Dict[str, Any]] = {}
+        models: Dict[str, str] = {}  # custom_id -> 提交时选用的档位模型，结果回流时按它记账与续跑
+        requests: List[Dict[str, Any]] = []
+
+        for record_id, record in records.items():
+            body = results.get(record_id)
+            try:
+                self.manager.usage.record(record["sender_id"], "router", self.manager.router_model, body.get("usage"))
+                plan = RouterPlan.model_validate_json(body["choices"][0]["message"]["content"])
+            except Exception as e:
+                print(f"[Backlog] 消息 [{record_id}] Router 批次结果无效: {e}")
+                self._fail(record, e)
+                continue
+
+            if not plan.delegations:
+                # 无需分发部门，直接走常规完成路径；单条失败不影响同批次的其他消息
+                try:
+                    await self.on_complete(record, self.manager._assemble_response(plan, [], record["sender_id"], record["content"]))
+                except Exception as e:
+                    print(f"[Backlog] 消息 [{record_id}] 完成处理失败: {e}")
+                    self._fail(record, e)
+                continue
+
+            plans[record_id] = plan.model_dump()
+            for index, delegation in enumerate(plan.delegations):
+                tiers, tier_index = self.manager._select_tier(delegation.agent_name, delegation.task_description, record["sender_id"])
+                custom_id = f"{record_id}:{index}"
+                models[custom_id] = tiers[tier_index]["model"]
+                requests.append({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": CHAT_COMPLETIONS_ENDPOINT,
+                    "body": {
+                        "model": models[custom_id],
+                        "messages": self.manager._build_sub_agent_messages(delegation.agent_name, delegation.task_description),
+                        "tools": TOOLS_SCHEMA,
+                        "tool_choice": "auto"
+                    }
+                })
+
+        if not requests:
+            return
+
+        provider_job_id = await self.backend.submit(requests)
+        agents_job = self.supabase.table("batch_jobs").insert({
+            "provider_job_id": provider_job_id,
+            "stage": "agents",
+            "status": "in_progress",
+            "record_ids": list(plans.keys()),
+            "payload": {"plans": plans, "models": models}
+        }).execute().data[0]
+        self.supabase.table("feishu_messages").update({"batch_job_id": agents_job["id"]}).in_("id", list(plans.keys())).execute()
+        print(f"📦 [Backlog] 已提交部门批次 {provider_job_id}，包含 {len(requests)} 个分发任务")
+
+    # -------------------------- 第二段：各部门 --------------------------
+
+    async def _sub_result_from_batch(self, delegation, body: Optional[Dict[str, Any]], user_id: str,
+                                     submitted_model: Optional[str] = None) -> str:
+        """把批次响应转成部门回执；需 Tool Call 时在本地续跑，未通过校验则升级模型，批次失败则回退到交互式调用"""
+        from openai.types.chat import ChatCompletion
+
+        if body is None:
+            return await self.manager._call_sub_agent(delegation.agent_name, delegation.task_description, user_id)
+
+        agent_name, task_desc = delegation.agent_name, delegation.task_description
+        tiers, tier_index = self.manager._select_tier(agent_name, task_desc, user_id)
+        messages = self.manager._build_sub_agent_messages(agent_name, task_desc)
+        agent_model = submitted_model or tiers[tier_index]["model"]
+        completion = ChatCompletion.model_validate(body)
+        # 按提交时的档位模型名记账 (completion.model 是带日期的版本号，查不到单价)
+        self.manager.usage.record(user_id, agent_name, agent_model, completion.usage)
+        reply = await self.manager._finish_sub_agent(agent_name, agent_model, messages, completion.choices[0].message, user_id)
+        return await self.manager._escalate_sub_agent(agent_name, task_desc, user_id, tiers, tier_index, reply=reply)
+
+    async def _handle_agents_results(self, job: Dict[str, Any], records: Dict[str, Dict[str, Any]], results: Dict[str, Optional[Dict[str, Any]]]):
+        plans = job.get("payload", {}).get("plans", {})
+        models = job.get("payload", {}).get("models", {})
+
+        for record_id, record in records.items():
+            try:
+                plan = RouterPlan.model_validate(plans[record_id])
+                sub_results = await asyncio.gather(*(
+                    self._sub_result_from_batch(delegation, results.get(f"{record_id}:{index}"), record["sender_id"],
+                                                models.get(f"{record_id}:{index}"))
+                    for index, delegation in enumerate(plan.delegations)
+                ))
+                await self.on_complete(record, self.manager._assemble_response(plan, list(sub_results), record["sender_id"], record["content"]))
+            except Exception as e:
+                print(f"[Backlog] 消息 [{record_id}] 部门批次结果处理失败: {e}")
+                self._fail(record, e)
+
+    # -------------------------- 状态跟踪 --------------------------
+
+    def _release(self, record_ids: List[str]):
+        """批次处理失败的消息退回 pending，由交互路径或下一个批次重新处理 (只处理仍为 batched 的行，已完成的不会被重跑)"""
+        if record_ids:
+            self.supabase.table("feishu_messages").update({"status": "pending", "batch_job_id": None}) \
+                .in_("id", record_ids).eq("status", "batched").execute()
+
+    def _fail(self, record: Dict[str, Any], error: Exception):
+        """单条消息失败：交给 on_failure 计入重试次数 (超过上限标记 error)，避免同一条消息被无限次退回"""
+        if self.on_failure:
+            self.on_failure(record, error)
+        else:
+            self._release([record["id"]])
+
+    async def poll_jobs(self):
+        jobs = self.supabase.table("batch_jobs").select("*").eq("status", "in_progress").execute().data or []
+        for job in jobs:
+            status = await self.backend.poll(job["provider_job_id"])
+            if status == "in_progress":
+                continue
+
+            if status == "failed":
+                print(f"❌ [Backlog] 批次 {job['provider_job_id']} 失败，消息退回 pending")
+                self._release(job["record_ids"])
+                self.supabase.table("batch_jobs").update({"status": "failed"}).eq("id", job["id"]).execute()
+                continue
+
+            results = await self.backend.results(job["provider_job_id"])
+            rows = self.supabase.table("feishu_messages").select("*").in_("id", job["record_ids"]).execute().data or []
+            # 重放同一批次时，已完成或已退回的消息不再处理，避免重复执行 Notion 动作
+            records = {row["id"]: row for row in rows if row["status"] == "batched"}
+
+            if job["stage"] == "router":
+                await self._handle_router_results(job, records, results)
+            else:
+                await self._handle_agents_results(job, records, results)
+
+            self.supabase.table("batch_jobs").update({"status": "completed"}).eq("id", job["id"]).execute()
+            print(f"✅ [Backlog] 批次 {job['provider_job_id']} ({job['stage']}) 结果已回流")
@@ -0,0 +1,219 @@
+import os
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Any, Tuple
+
+# ---------------------------------------------------------------------------
+# 每日容量聚合：按 (日期, 状态) 维护任务时长与数量
+# 我们的代码每次创建/更新 Notion 任务时增量更新，定期与 Notion 全量对账，
+# 容量检查与超载判断因此只需一次主键查询，而不是每次全表扫描求和。
+# Notion 任务库没有负责人字段，对账无法区分用户，因此聚合不按用户拆分。
+# ---------------------------------------------------------------------------
+
+CAPACITY_SCHEMA_VERSION = 2  # 聚合是可重建的派生数据，结构变化时直接重建
+CAPACITY_DB_PATH = os.environ.get("CAPACITY_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "capacity.db"))
+CAPACITY_RECONCILE_SECONDS = int(os.environ.get("CAPACITY_RECONCILE_SECONDS", "3600"))  # 距上次对账超过该秒数则重新对账
+
+
+def parse_task_page(page: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """从 Notion 任务页面 (API 返回的 page 对象) 中提取 page_id / date / status / hours"""
+    if not page or "id" not in page:
+        return None
+    properties = page.get("properties", {})
+
+    date_prop = properties.get("Date", {})
+    date_value = (date_prop.get("date") or {}).get("start") if date_prop.get("type") == "date" else None
+
+    status_prop = properties.get("Status", {})
+    status_value = None
+    if status_prop.get("type") in ("status", "select"):
+        status_value = (status_prop.get(status_prop["type"]) or {}).get("name")
+
+    hours_prop = properties.get("Est. Time", {})
+    hours_value = hours_prop.get("number") if hours_prop.get("type") == "number" else None
+
+    return {
+        "page_id": page["id"],
+        "date": date_value[:10] if date_value else None,
+        "status": status_value,
+        "hours": float(hours_value or 0.0),
+        "archived": bool(page.get("archived") or page.get("in_trash")),
+    }
+
+
+class CapacityStore:
+    """基于 SQLite 的容量聚合存储 (多进程共享同一文件，WAL 模式)"""
+
+    def __init__(self, path: str = CAPACITY_DB_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != CAPACITY_SCHEMA_VERSION:
+            self.conn.executescript("""
+                DROP TABLE IF EXISTS capacity_tasks;
+                DROP TABLE IF EXISTS capacity_daily;
+                DROP TABLE IF EXISTS capacity_reconciled;
+            """)
+            self.conn.execute(f"PRAGMA user_version = {CAPACITY_SCHEMA_VERSION}")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS capacity_tasks (
+                page_id TEXT PRIMARY KEY,
+                date TEXT,
+                status TEXT,
+                hours REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS capacity_daily (
+                date TEXT NOT NULL,
+                status TEXT NOT NULL,
+                hours REAL NOT NULL DEFAULT 0,
+                task_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (date, status)
+            );
+            CREATE TABLE IF NOT EXISTS capacity_reconciled (
+                date TEXT PRIMARY KEY,
+                reconciled_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_capacity_tasks_date ON capacity_tasks(date);
+        """)
+
+    def _bump(self, date: Optional[str], status: Optional[str], hours: float, count: int):
+        if not date or not status:
+            return
+        self.conn.execute("""
+            INSERT INTO capacity_daily (date, status, hours, task_count) VALUES (?, ?, ?, ?)
+            ON CONFLICT (date, status) DO UPDATE SET
+                hours = hours + excluded.hours,
+                task_count = task_count + excluded.task_count
+        """, (date, status, hours, count))
+
+    # -------------------------- 增量更新 --------------------------
+
+    def record_task(self, page_id: str, date: Optional[str], status: Optional[str], hours: Optional[float] = None):
+        """任务创建或更新后调用：把旧桶的贡献移到新桶。hours 为 None 时保留原有时长"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                old = self.conn.execute(
+                    "SELECT date, status, hours FROM capacity_tasks WHERE page_id = ?", (page_id,)
+                ).fetchone()
+                if old:
+                    self._bump(old[0], old[1], -old[2], -1)
+                    if hours is None:
+                        hours = old[2]
+                hours = float(hours or 0.0)
+
+                self.conn.execute("""
+                    INSERT INTO capacity_tasks (page_id, date, status, hours) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (page_id) DO UPDATE SET
+                        date = excluded.date, status = excluded.status, hours = excluded.hours
+                """, (page_id, date, status, hours))
+                self._bump(date, status, hours, 1)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def remove_task(self, page_id: str):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                old = self.conn.execute(
+                    "SELECT date, status, hours FROM capacity_tasks WHERE page_id = ?", (page_id,)
+                ).fetchone()
+                if old:
+                    self._bump(old[0], old[1], -old[2], -1)
+                    self.conn.execute("DELETE FROM capacity_tasks WHERE page_id = ?", (page_id,))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def record_page(self, page: Dict[str, Any]):
+        """直接用 Notion API 返回的任务页面更新聚合 (归档/删除的页面会被移除)"""
+        task = parse_task_page(page)
+        if not task:
+            return
+        if task["archived"]:
+            self.remove_task(task["page_id"])
+        else:
+            self.record_task(task["page_id"], task["date"], task["status"], task["hours"])
+
+    # -------------------------- 查询 --------------------------
+
+    def get(self, date: str, status: str) -> Tuple[float, int]:
+        """O(1) 查询某天某状态的 (总时长, 任务数)"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT hours, task_count FROM capacity_daily WHERE date = ? AND status = ?", (date, status)
+            ).fetchone()
+        return (round(row[0], 4), row[1]) if row else (0.0, 0)
+
+    # -------------------------- 对账 --------------------------
+
+    def needs_reconcile(self, date: str, max_age: int = CAPACITY_RECONCILE_SECONDS) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT reconciled_at FROM capacity_reconciled WHERE date = ?", (date,)
+            ).fetchone()
+        return row is None or time.time() - row[0] > max_age
+
+    def reconcile(self, date: str, pages: List[Dict[str, Any]]):
+        """以 Notion 查询结果为准重建某天的聚合。pages 应为该日期的全部任务页面"""
+        tasks = [t for t in (parse_task_page(p) for p in pages) if t and not t["archived"]]
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 在 Notion 中已改期到本日的任务，先从原日期的聚合中扣除
+                for t in tasks:
+                    old = self.conn.execute(
+                        "SELECT date, status, hours FROM capacity_tasks WHERE page_id = ?", (t["page_id"],)
+                    ).fetchone()
+                    if old and old[0] != date:
+                        self._bump(old[0], old[1], -old[2], -1)
+                self.conn.execute("DELETE FROM capacity_tasks WHERE date = ?", (date,))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO capacity_tasks (page_id, date, status, hours) VALUES (?, ?, ?, ?)",
+                    [(t["page_id"], t["date"], t["status"], t["hours"]) for t in tasks]
+                )
+                self.conn.execute("DELETE FROM capacity_daily WHERE date = ?", (date,))
+                self.conn.execute("""
+                    INSERT INTO capacity_daily (date, status, hours, task_count)
+                    SELECT date, status, SUM(hours), COUNT(*) FROM capacity_tasks
+                    WHERE date = ? AND status IS NOT NULL
+                    GROUP BY date, status
+                """, (date,))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO capacity_reconciled (date, reconciled_at) VALUES (?, ?)",
+                    (date, time.time())
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+
+_store: Optional[CapacityStore] = None
+
+
+def get_capacity_store() -> CapacityStore:
+    """进程内共享的 CapacityStore 单例"""
+    global _store
+    if _store is None:
+        _store = CapacityStore()
+    return _store
+
+
+def track_task_page(response: Dict[str, Any], tasks_database_id: str):
+    """Notion 写操作成功后调用：若返回的页面属于任务库，则增量更新容量聚合"""
+    if not response or "error" in response:
+        return
+    parent_id = (response.get("parent") or {}).get("database_id", "")
+    if parent_id.replace("-", "") != tasks_database_id.replace("-", ""):
+        return
+    try:
+        get_capacity_store().record_page(response)
+    except Exception as e:
+        # 聚合只是加速用的派生数据，写失败不影响主流程，下次对账会修正
+        print(f"[Capacity] 更新容量聚合失败: {e}")
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Any
+
+# ---------------------------------------------------------------------------
+# 飞书回复发件箱 (Transactional Outbox)
+# Worker 只负责把渲染好的卡片与 "completed" 状态在同一事务内写入 feishu_outbox，
+# 由独立的异步 Dispatcher 负责投递：连接池复用、Token 缓存、限流与指数退避重试。
+# ---------------------------------------------------------------------------
+
+FEISHU_TOKEN_URL = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal"
+FEISHU_SEND_URL = "https://open.feishu.cn/open-apis/im/v1/messages?receive_id_type=open_id"
+
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "20"))            # 每轮认领的待发送条数
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))         # 超过后标记 failed
+OUTBOX_BACKOFF_BASE = float(os.environ.get("OUTBOX_BACKOFF_BASE", "2"))       # 退避基数 (秒)
+OUTBOX_BACKOFF_MAX = float(os.environ.get("OUTBOX_BACKOFF_MAX", "300"))       # 单次退避上限 (秒)
+FEISHU_RATE_LIMIT_QPS = float(os.environ.get("FEISHU_RATE_LIMIT_QPS", "20"))  # 发送消息接口的应用级限速
+
+# 飞书业务错误码：触发频控
+FEISHU_RATE_LIMIT_CODES = {99991400}
+
+
+def build_feishu_card(buttons: list, coach_message: str) -> Dict[str, Any]:
+    """组装飞书互动卡片 JSON：markdown 正文 + Button 转换的 action 按钮"""
+    card_content = {
+        "config": {"wide_screen_mode": True},
+        "header": {
+            "title": {"tag": "plain_text", "content": "内阁总管回复"}
+        },
+        "elements": [
+            {
+                "tag": "markdown",
+                "content": coach_message
+            }
+        ]
+    }
+
+    # 将按钮追加为 Action
+    if buttons:
+        action_element = {
+            "tag": "action",
+            "actions": []
+        }
+        for btn in buttons:
+            button_type = "primary" if btn.recommended else "default"
+            action_element["actions"].append({
+                "tag": "button",
+                "text": {"tag": "plain_text", "content": btn.text},
+                "type": button_type,
+                "value": {"payload": btn.action_payload}
+            })
+        card_content["elements"].append(action_element)
+
+    return card_content
+
+
+def enqueue_reply(supabase, record_id: str, receive_id: str, card: Dict[str, Any]):
+    """在同一事务内写入发件箱并把消息标记为 completed (见 schema.sql 中的 enqueue_feishu_reply)"""
+    supabase.rpc("enqueue_feishu_reply", {
+        "p_record_id": record_id,
+        "p_receive_id": receive_id,
+        "p_card": card
+    }).execute()
+
+
+class FeishuSendError(Exception):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """令牌桶限流，保证全进程的发送速率不超过飞书频控"""
+
+    def __init__(self, qps: float):
+        self.rate = qps
+        self.capacity = max(1.0, qps)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FeishuOutboxDispatcher:
+    """发件箱投递器：认领到期的待发送卡片，并发发送并回写状态"""
+
+    def __init__(self, supabase, poll_interval: float = 1.0):
+        self.supabase = supabase
+        self.poll_interval = poll_interval
+        self.app_id = os.environ.get("FEISHU_APP_ID")
+        self.app_secret = os.environ.get("FEISHU_APP_SECRET")
+        self._client = None
+        self.rate_limiter = RateLimiter(FEISHU_RATE_LIMIT_QPS)
+        self._token: Optional[str] = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+
+    @property
+    def client(self):
+        """连接池在首次使用时才创建 (httpx 同时延迟导入)"""
+        if self._client is None:
+            import httpx
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(10.0),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+            )
+        return self._client
+
+    async def warm_up(self) -> bool:
+        """预取 tenant_access_token：同时建立到飞书的 TLS 连接，首条回复无需再握手与换 Token"""
+        if not self.app_id or not self.app_secret:
+            return False
+        try:
+            await self._get_access_token()
+            return True
+        except Exception as e:
+            print(f"[Warm-up] 飞书连接预热失败: {e}")
+            return False
+
+    async def _get_access_token(self) -> str:
+        """tenant_access_token 有效期约 2 小时，缓存到过期前 5 分钟"""
+        async with self._token_lock:
+            if self._token and time.time() < self._token_expires_at:
+                return self._token
+
+            resp = await self.client.post(FEISHU_TOKEN_URL, json={"app_id": self.app_id, "app_secret": self.app_secret})
+            resp.raise_for_status()
+            body = resp.json()
+            token = body.get("tenant_access_token")
+            if not token:
+                raise FeishuSendError(f"获取飞书 Token 失败: {body.get('msg')}")
+            self._token = token
+            self._token_expires_at = time.time() + int(body.get("expire", 7200)) - 300
+            return token
+
+    async def send(self, receive_id: str, card: Dict[str, Any]):
+        access_token = await self._get_access_token()
+        await self.rate_limiter.acquire()
+
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+        payload = {
+            "receive_id": receive_id,
+            "msg_type": "interactive",
+            "content": json.dumps(card)
+        }
+        resp = await self.client.post(FEISHU_SEND_URL, headers=headers, json=payload)
+
+        body = {}
+        try:
+            body = resp.json()
+        except ValueError:
+            pass
+        code = body.get("code", 0)
+
+        if resp.status_code == 429 or code in FEISHU_RATE_LIMIT_CODES:
+            retry_after = resp.headers.get("x-ogw-ratelimit-reset") or resp.headers.get("Retry-After")
+            raise FeishuSendError("飞书频控限流", retry_after=float(retry_after) if retry_after else None)
+        if resp.status_code == 401 or code == 99991663:
+            # Token 失效，清掉缓存下次重新获取
+            self._token = None
+        resp.raise_for_status()
+        if code != 0:
+            raise FeishuSendError(f"飞书返回错误 {code}: {body.get('msg')}")
+
+    async def _deliver(self, row: Dict[str, Any]):
+        try:
+            await self.send(row["receive_id"], row["card"])
+        except Exception as e:
+            attempts = row["attempts"] + 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                print(f"❌ [Outbox] 回复 {row['id']} 发送失败 {attempts} 次，放弃: {e}")
+                update = {"status": "failed", "attempts": attempts, "last_error": str(e)[:1000]}
+            else:
+                delay = getattr(e, "retry_after", None) or min(OUTBOX_BACKOFF_BASE * (2 ** attempts), OUTBOX_BACKOFF_MAX)
+                next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=delay)
+                print(f"[Outbox] 回复 {row['id']} 第 {attempts} 次发送失败，{delay:.0f} 秒后重试: {e}")
+                update = {
+                    "status": "pending",
+                    "attempts": attempts,
+                    "last_error": str(e)[:1000],
+                    "next_attempt_at": next_attempt_at.isoformat()
+                }
+            self.supabase.table("feishu_outbox").update(update).eq("id", row["id"]).execute()
+            return
+
+        self.supabase.table("feishu_outbox").update({
+            "status": "sent",
+            "attempts": row["attempts"] + 1,
+            "sent_at": datetime.now(timezone.utc).isoformat()
+        }).eq("id", row["id"]).execute()
+        print(f"✅ 已成功回复飞书用户 {row['receive_id']}")
+
+    async def dispatch_once(self) -> int:
+        """认领一批到期的回复并并发投递，返回本轮处理条数"""
+        rows: List[Dict[str, Any]] = self.supabase.rpc("claim_feishu_outbox", {"p_limit": OUTBOX_BATCH_SIZE}).execute().data or []
+        if rows:
+            await asyncio.gather(*(self._deliver(row) for row in rows))
+        return len(rows)
+
+    async def run(self):
+        if not self.app_id or not self.app_secret:
+            print("警告: 缺少 FEISHU_APP_ID 或 FEISHU_APP_SECRET，发件箱投递器未启动，回复将保留在 feishu_outbox 中。")
+            return
+
+        print("📮 启动飞书发件箱投递器...")
+        try:
+            while True:
+                try:
+                    if not await self.dispatch_once():
+                        await asyncio.sleep(self.poll_interval)
+                except Exception as e:
+                    print(f"[Outbox] 投递循环发生异常: {e}")
+                    await asyncio.sleep(5)
+        finally:
+            if self._client is not None:
+                await self._client.aclose()
+
+
+if __name__ == "__main__":
+    from supabase import create_client
+
+    supabase_url = os.environ.get("SUPABASE_URL")
+    supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+    if not supabase_url or not supabase_key:
+        print("🔴 缺少 Supabase 环境变量 (SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)")
+    else:
+        try:
+            asyncio.run(FeishuOutboxDispatcher(create_client(supabase_url, supabase_key)).run())
+        except KeyboardInterrupt:
+            print("发件箱投递器已停止。")
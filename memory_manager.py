@@ -4,10 +4,12 @@ from typing import List, Dict, Any
 class MemoryManager:
     """会话长记忆管理器"""
     
-    def __init__(self, max_history_per_user: int = 10):
+    def __init__(self, max_history_per_user: int = 10, trim_step: int = 1):
         # 简单内存字典。在生产环境中可替换为 SQLite 或 Redis
         self.store: Dict[str, List[Dict[str, Any]]] = {}
         self.max_history = max_history_per_user
+        # 超限时一次裁掉的条数；大于 1 时历史前缀能在多轮内保持不变，利于 Prompt 缓存
+        self.trim_step = max(1, min(trim_step, max_history_per_user))
 
     def get_history(self, user_id: str) -> List[Dict[str, Any]]:
         """获取特定用户的上下文历史"""
@@ -28,7 +30,8 @@ class MemoryManager:
         
         # 保持在最大历史限制以内以节省 Token
         if len(self.store[user_id]) > self.max_history:
-            self.store[user_id] = self.store[user_id][-self.max_history:]
+            keep = self.max_history - self.trim_step + 1
+            self.store[user_id] = self.store[user_id][-keep:]
             
     def clear_history(self, user_id: str):
         """清空用户的上下文历史"""
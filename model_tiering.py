@@ -0,0 +1,53 @@
+import re
+from typing import Dict, List, Any, Optional
+
+# ---------------------------------------------------------------------------
+# 模型分级 (Model Tiering)：按任务复杂度为每次委派挑选模型档位
+# agents_config.json 中每个部门可配置 tiers (由便宜到强排列)：
+#   {"model": "gpt-4o-mini", "max_complexity": 0.4, "cost_per_1k_tokens": 0.00015, "avg_latency_ms": 900}
+# 本地估算复杂度 (0~1) 选择首个 max_complexity 覆盖该复杂度的档位，回复未通过校验时逐级升级。
+# ---------------------------------------------------------------------------
+
+# 需要深度推理的信号词
+HARD_SIGNALS = ['架构', '设计', '重构', '优化', '性能', '并发', '算法', '调试', '排查', '方案',
+                '分析', '复盘', '报表', '策略', '对比', '评估', '推导', '系统', '完整', '详细']
+# 明显的轻量任务信号词
+EASY_SIGNALS = ['简单', '一句话', '精简', '翻译', '改写', '润色', '问候', '确认', '20字', '短']
+# 可能需要调用工具的信号词 (工具调用多一轮往返，弱模型更容易出错)
+TOOL_SIGNALS = ['搜索', '查一下', '最新', '新闻', '时间', '几点', '今天']
+# 代码块或多步骤列表
+STRUCTURE_PATTERN = re.compile(r'```|\n\s*\d+[\.、]|\n\s*[-•]')
+
+
+def estimate_complexity(task_desc: str) -> float:
+    """基于长度、关键词、结构与工具需求的本地复杂度估算，范围 0~1"""
+    text = (task_desc or '').lower()
+
+    score = min(len(text) / 400, 1.0) * 0.35
+    score += min(sum(signal in text for signal in HARD_SIGNALS), 3) * 0.15
+    score -= min(sum(signal in text for signal in EASY_SIGNALS), 2) * 0.15
+    if any(signal in text for signal in TOOL_SIGNALS):
+        score += 0.1
+    if STRUCTURE_PATTERN.search(text):
+        score += 0.15
+
+    return round(max(0.0, min(score, 1.0)), 3)
+
+
+def select_tier(tiers: List[Dict[str, Any]], complexity: float) -> int:
+    """返回首个能覆盖该复杂度的档位下标；都不覆盖时使用最强档位"""
+    for index, tier in enumerate(tiers):
+        if complexity <= tier.get('max_complexity', 1.0):
+            return index
+    return len(tiers) - 1
+
+
+# 模型拒答或敷衍的常见开头
+REFUSAL_PREFIXES = ('抱歉，我无法', '抱歉，我不能', '对不起，我无法', "i'm sorry", 'i cannot', "i can't", 'as an ai')
+
+
+def validate_reply(reply: Optional[str], min_length: int = 8) -> bool:
+    """判断回复是否可用；不可用时由调用方升级到更强的模型重试"""
+    if not reply or len(reply.strip()) < min_length:
+        return False
+    return not reply.strip().lower().startswith(REFUSAL_PREFIXES)
@@ -1,8 +1,9 @@
-import requests
 from typing import Dict, Optional
 import time
 import os
 
+from capacity_store import track_task_page
+
 DB_CONFIG = {
     'projects': {
         'id': 'your-notion-projects-database-id',
@@ -28,21 +29,34 @@ HEADERS = {
     'Content-Type': 'application/json'
 }
 
+_session = None
+
+def get_session():
+    """进程内共享的 requests.Session：首次使用时才导入 requests，之后复用连接池中的 TLS 连接"""
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+        _session.headers.update(HEADERS)
+    return _session
+
 class NotionClient:
     """Notion API 客户端 (独立封装)"""
     
     @staticmethod
     def make_request(method: str, endpoint: str, data: Optional[Dict] = None) -> Dict:
         """发送 HTTP 请求"""
+        import requests
         url = f'{BASE_URL}/{endpoint}'
+        session = get_session()
         
         try:
             if method == 'GET':
-                response = requests.get(url, headers=HEADERS, params=data)
+                response = session.get(url, params=data)
             elif method == 'POST':
-                response = requests.post(url, headers=HEADERS, json=data)
+                response = session.post(url, json=data)
             elif method == 'PATCH':
-                response = requests.patch(url, headers=HEADERS, json=data)
+                response = session.patch(url, json=data)
             else:
                 raise ValueError(f'不支持的 HTTP 方法: {method}')
             
@@ -58,6 +72,16 @@ class NotionClient:
         except requests.exceptions.RequestException as e:
             return {'error': str(e)}
     
+    @staticmethod
+    def warm_up(timeout: float = 5.0) -> bool:
+        """预先建立到 Notion 的 TLS 连接 (留在连接池中供首个真实请求复用)"""
+        try:
+            get_session().get(f'{BASE_URL}/users/me', timeout=timeout)
+            return True
+        except Exception as e:
+            print(f'[Warm-up] Notion 连接预热失败: {e}')
+            return False
+    
     @staticmethod
     def query_database(database_id: str, filter: Optional[Dict] = None) -> Dict:
         data = {}
@@ -71,9 +95,56 @@ class NotionClient:
             'parent': {'database_id': database_id, 'type': 'database_id'},
             'properties': properties
         }
-        return NotionClient.make_request('POST', 'pages', data)
+        result = NotionClient.make_request('POST', 'pages', data)
+        # 任务库的写入同步增量更新每日容量聚合
+        track_task_page(result, DB_CONFIG['tasks']['id'])
+        return result
     
     @staticmethod
     def update_page(page_id: str, properties: Dict) -> Dict:
         data = {'properties': properties}
-        return NotionClient.make_request('PATCH', f'pages/{page_id}', data)
+        result = NotionClient.make_request('PATCH', f'pages/{page_id}', data)
+        track_task_page(result, DB_CONFIG['tasks']['id'])
+        return result
+
+
+# 任务库字段类型 (见 PROMPT.md 表2)，用于把 Router 动作中的 data 转成 Notion properties
+TASK_PROPERTY_TYPES = {
+    'Task Name': 'title',
+    'Type': 'select',
+    'Status': 'status',
+    'Date': 'date',
+    'Est. Time': 'number',
+    'Actual Time': 'number',
+    'AI Context': 'rich_text',
+}
+
+# 状态的中文显示名 -> API 值
+TASK_STATUS_VALUES = {
+    '收件箱': 'Not started',
+    '今日待办': 'Not started',
+    '顺延': 'Not started',
+    '进行中': 'In progress',
+    '已完成': 'Done',
+}
+
+def build_task_properties(data: Dict) -> Dict:
+    """把 {字段名: 值} 转成任务库的 Notion properties；未知字段 (如需页面 ID 的 Project 关联) 与空值跳过"""
+    properties = {}
+    for name, value in data.items():
+        kind = TASK_PROPERTY_TYPES.get(name)
+        if kind is None or value is None or value == '':
+            continue
+        if kind == 'title':
+            properties[name] = {'title': [{'text': {'content': str(value)}}]}
+        elif kind == 'rich_text':
+            properties[name] = {'rich_text': [{'text': {'content': str(value)}}]}
+        elif kind == 'status':
+            properties[name] = {'status': {'name': TASK_STATUS_VALUES.get(value, value)}}
+        elif kind == 'select':
+            properties[name] = {'select': {'name': str(value)}}
+        elif kind == 'date':
+            properties[name] = {'date': {'start': str(value)}}
+        elif kind == 'number':
+            properties[name] = {'number': float(value)}
+    return properties
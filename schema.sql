@@ -13,3 +13,349 @@ CREATE TABLE IF NOT EXISTS public.feishu_messages (
 
 -- Setup an index on status for faster polling
 CREATE INDEX IF NOT EXISTS idx_feishu_messages_status ON public.feishu_messages(status);
+
+-- ---------------------------------------------------------------------------
+-- 积压模式 (Backlog Mode)：OpenAI Batch API 批次状态跟踪
+-- feishu_messages.status 新增取值 batched (已提交批次，等待结果回流)
+-- ---------------------------------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS public.batch_jobs (
+    id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+    provider_job_id TEXT NOT NULL,         -- OpenAI Batch ID (或本地替身的任务 ID)
+    stage TEXT NOT NULL,                   -- 流水线阶段: router, agents
+    status TEXT DEFAULT 'in_progress' NOT NULL, -- 状态: in_progress, completed, failed
+    record_ids UUID[] NOT NULL,            -- 批次包含的 feishu_messages.id
+    payload JSONB DEFAULT '{}'::jsonb NOT NULL, -- 阶段间传递的数据 (如 agents 阶段的 RouterPlan)
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_batch_jobs_status ON public.batch_jobs(status);
+
+ALTER TABLE public.feishu_messages ADD COLUMN IF NOT EXISTS batch_job_id UUID REFERENCES public.batch_jobs(id);
+
+-- ---------------------------------------------------------------------------
+-- 热轮询优化：优先级 + 只覆盖 pending 行的部分索引
+-- priority: 0 = P0 (紧急，插队处理), 1 = P1 (默认), 2 = P2
+-- 由 Edge Function 按 TaskClassifier.detect_urgency 的同款规则写入
+-- ---------------------------------------------------------------------------
+
+ALTER TABLE public.feishu_messages ADD COLUMN IF NOT EXISTS priority SMALLINT DEFAULT 1 NOT NULL;
+
+-- Worker 按 (priority, created_at) 取 pending 消息；部分索引只包含 pending 行，
+-- 已完成的历史行再多也不会拖慢轮询
+CREATE INDEX IF NOT EXISTS idx_feishu_messages_pending
+    ON public.feishu_messages(priority, created_at)
+    WHERE status = 'pending';
+
+-- 全量 status 索引会随已完成行无限膨胀，已由上面的部分索引取代
+DROP INDEX IF EXISTS public.idx_feishu_messages_status;
+
+-- ---------------------------------------------------------------------------
+-- 自动维护 updated_at
+-- ---------------------------------------------------------------------------
+
+CREATE OR REPLACE FUNCTION public.set_updated_at()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = NOW();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_feishu_messages_updated_at ON public.feishu_messages;
+CREATE TRIGGER trg_feishu_messages_updated_at
+    BEFORE UPDATE ON public.feishu_messages
+    FOR EACH ROW EXECUTE FUNCTION public.set_updated_at();
+
+DROP TRIGGER IF EXISTS trg_batch_jobs_updated_at ON public.batch_jobs;
+CREATE TRIGGER trg_batch_jobs_updated_at
+    BEFORE UPDATE ON public.batch_jobs
+    FOR EACH ROW EXECUTE FUNCTION public.set_updated_at();
+
+-- ---------------------------------------------------------------------------
+-- 归档与保留：已完成/出错的旧消息按月分区归档，超过保留期的分区整体删除
+-- 原始行以 JSONB 整行保存，热表后续加列无需同步修改归档表结构
+-- ---------------------------------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS public.feishu_messages_archive (
+    id UUID NOT NULL,
+    message_id TEXT NOT NULL,
+    sender_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    archived_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL,
+    record JSONB NOT NULL,                 -- 归档时的完整行
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- 创建 p_month 所在月份的归档分区 (已存在则跳过)
+CREATE OR REPLACE FUNCTION public.ensure_feishu_archive_partition(p_month DATE)
+RETURNS VOID AS $$
+DECLARE
+    month_start DATE := date_trunc('month', p_month)::DATE;
+    partition_name TEXT := 'feishu_messages_archive_' || to_char(month_start, 'YYYYMM');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS public.%I PARTITION OF public.feishu_messages_archive
+            FOR VALUES FROM (%L) TO (%L)',
+        partition_name, month_start, (month_start + INTERVAL '1 month')::DATE
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+-- 保留任务：把 p_archive_after 之前完成的消息移入归档分区，并删除早于 p_retention 的归档分区
+CREATE OR REPLACE FUNCTION public.archive_feishu_messages(
+    p_archive_after INTERVAL DEFAULT INTERVAL '7 days',
+    p_retention INTERVAL DEFAULT INTERVAL '180 days'
+)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE;
+    partition RECORD;
+    moved_count INTEGER;
+BEGIN
+    FOR month_start IN
+        SELECT DISTINCT date_trunc('month', created_at)::DATE
+        FROM public.feishu_messages
+        WHERE status IN ('completed', 'error') AND updated_at < NOW() - p_archive_after
+    LOOP
+        PERFORM public.ensure_feishu_archive_partition(month_start);
+    END LOOP;
+
+    WITH moved AS (
+        DELETE FROM public.feishu_messages m
+        WHERE m.status IN ('completed', 'error') AND m.updated_at < NOW() - p_archive_after
+        RETURNING m.*
+    )
+    INSERT INTO public.feishu_messages_archive (id, message_id, sender_id, status, created_at, record)
+    SELECT moved.id, moved.message_id, moved.sender_id, moved.status, moved.created_at, to_jsonb(moved)
+    FROM moved;
+    GET DIAGNOSTICS moved_count = ROW_COUNT;
+
+    -- 删除整月都早于保留期的分区 (DROP 分区远比逐行 DELETE 便宜)
+    FOR partition IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'public.feishu_messages_archive'::regclass
+          AND to_date(right(c.relname, 6), 'YYYYMM') + INTERVAL '1 month' < NOW() - p_retention
+    LOOP
+        EXECUTE format('DROP TABLE IF EXISTS public.%I', partition.relname);
+    END LOOP;
+
+    RETURN moved_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 每日定时执行保留任务 (需在 Supabase 中启用 pg_cron 扩展)
+-- SELECT cron.schedule('archive-feishu-messages', '17 3 * * *', $$SELECT public.archive_feishu_messages()$$);
+
+-- ---------------------------------------------------------------------------
+-- 卡片按钮回调：与文本消息共用队列，Worker 按 event_type 走本地快速通道
+-- event_type: message (文本消息, 走 LLM 流水线), card_action (卡片按钮, content 为 action_payload)
+-- ---------------------------------------------------------------------------
+
+ALTER TABLE public.feishu_messages ADD COLUMN IF NOT EXISTS event_type TEXT DEFAULT 'message' NOT NULL;
+
+-- ---------------------------------------------------------------------------
+-- 处理检查点：RouterPlan、各部门结果与最终回复完成即落盘，重试时从最后完成的阶段续跑
+-- stage: routed (已有 RouterPlan), responded (已生成最终回复), actions_done (Notion 动作已执行), completed
+-- ---------------------------------------------------------------------------
+
+ALTER TABLE public.feishu_messages ADD COLUMN IF NOT EXISTS stage TEXT;
+ALTER TABLE public.feishu_messages ADD COLUMN IF NOT EXISTS router_plan JSONB;
+ALTER TABLE public.feishu_messages ADD COLUMN IF NOT EXISTS department_results JSONB DEFAULT '{}'::jsonb NOT NULL; -- 委派序号 -> 部门回执
+ALTER TABLE public.feishu_messages ADD COLUMN IF NOT EXISTS agent_response JSONB;
+ALTER TABLE public.feishu_messages ADD COLUMN IF NOT EXISTS attempts INTEGER DEFAULT 0 NOT NULL;
+ALTER TABLE public.feishu_messages ADD COLUMN IF NOT EXISTS last_error TEXT;
+ALTER TABLE public.feishu_messages ADD COLUMN IF NOT EXISTS not_before TIMESTAMP WITH TIME ZONE; -- 用户超额或失败退避时延后到该时间再认领
+
+-- ---------------------------------------------------------------------------
+-- 多进程 Worker 原子认领：FOR UPDATE SKIP LOCKED 保证同一条消息只被一个进程取走
+-- 按 sender_id 分片：第 p_shard 个进程 (共 p_shards 个) 只认领哈希落在本分片的用户，
+-- 同一用户的会话记忆因此只存在于一个进程中；且只有当该用户更早的消息都已处理完
+-- (没有更早的 pending，也没有 processing / batched) 时才认领下一条，保证同一用户的消息串行、按序处理
+-- 进程崩溃遗留的 processing 行超过 p_stale_after 未更新 (updated_at 由触发器维护) 即退回 pending 重新认领，
+-- 每次回收计入 attempts，达到 p_max_attempts 标记 error，避免必然导致崩溃的消息被无限回收
+-- 因配额或失败退避被延后的 pending 行在 not_before 之前跳过
+-- 调用: supabase.rpc("claim_feishu_messages", {"p_limit": N, "p_shard": i, "p_shards": n, "p_max_attempts": 3})
+-- ---------------------------------------------------------------------------
+
+DROP FUNCTION IF EXISTS public.claim_feishu_messages(INTEGER);
+DROP FUNCTION IF EXISTS public.claim_feishu_messages(INTEGER, INTERVAL);
+DROP FUNCTION IF EXISTS public.claim_feishu_messages(INTEGER, INTERVAL, INTEGER, INTEGER);
+
+CREATE OR REPLACE FUNCTION public.feishu_sender_shard(p_sender_id TEXT, p_shards INTEGER)
+RETURNS INTEGER AS $$
+    SELECT (hashtext(p_sender_id) & 2147483647) % GREATEST(p_shards, 1);
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION public.claim_feishu_messages(
+    p_limit INTEGER DEFAULT 1,
+    p_stale_after INTERVAL DEFAULT INTERVAL '10 minutes',
+    p_shard INTEGER DEFAULT 0,
+    p_shards INTEGER DEFAULT 1,
+    p_max_attempts INTEGER DEFAULT 3
+)
+RETURNS SETOF public.feishu_messages AS $$
+BEGIN
+    -- 1. 回收本分片崩溃遗留的 processing 行 (独立语句，不影响下面的认领查询走 pending 部分索引)
+    UPDATE public.feishu_messages
+    SET status = CASE WHEN attempts + 1 >= p_max_attempts THEN 'error' ELSE 'pending' END,
+        attempts = attempts + 1,
+        last_error = 'processing 超时未完成 (进程崩溃或卡死)，已回收'
+    WHERE status = 'processing'
+      AND updated_at < NOW() - p_stale_after
+      AND public.feishu_sender_shard(sender_id, p_shards) = p_shard;
+
+    -- 2. 按 (priority, created_at) 顺序认领每个空闲用户最早的一条消息
+    RETURN QUERY
+    UPDATE public.feishu_messages m
+    SET status = 'processing'
+    WHERE m.id IN (
+        SELECT c.id FROM public.feishu_messages c
+        WHERE c.status = 'pending'
+          AND (c.not_before IS NULL OR c.not_before <= NOW())
+          AND public.feishu_sender_shard(c.sender_id, p_shards) = p_shard
+          AND NOT EXISTS (
+              SELECT 1 FROM public.feishu_messages earlier
+              WHERE earlier.sender_id = c.sender_id
+                AND earlier.status = 'pending'
+                AND (earlier.created_at, earlier.id) < (c.created_at, c.id)
+          )
+          AND NOT EXISTS (
+              SELECT 1 FROM public.feishu_messages busy
+              WHERE busy.sender_id = c.sender_id
+                AND busy.status IN ('processing', 'batched')
+          )
+        ORDER BY c.priority, c.created_at
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING m.*;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 积压模式的批次认领：与 claim_feishu_messages 相同的逐用户串行规则，但不分片 (调度器只在 0 号进程运行)，
+-- 只认领文本消息，并直接标记为 batched。调度器在上传批次文件之前先认领，提交失败时再退回 pending，
+-- 上传期间交互认领循环与其他分片的进程都不会再取走这些行
+-- 调用: supabase.rpc("claim_feishu_messages_for_batch", {"p_limit": 500})
+CREATE OR REPLACE FUNCTION public.claim_feishu_messages_for_batch(p_limit INTEGER DEFAULT 500)
+RETURNS SETOF public.feishu_messages AS $$
+    UPDATE public.feishu_messages m
+    SET status = 'batched'
+    WHERE m.id IN (
+        SELECT c.id FROM public.feishu_messages c
+        WHERE c.status = 'pending'
+          AND c.event_type = 'message'
+          AND (c.not_before IS NULL OR c.not_before <= NOW())
+          AND NOT EXISTS (
+              SELECT 1 FROM public.feishu_messages earlier
+              WHERE earlier.sender_id = c.sender_id
+                AND earlier.status = 'pending'
+                AND (earlier.created_at, earlier.id) < (c.created_at, c.id)
+          )
+          AND NOT EXISTS (
+              SELECT 1 FROM public.feishu_messages busy
+              WHERE busy.sender_id = c.sender_id
+                AND busy.status IN ('processing', 'batched')
+          )
+        ORDER BY c.priority, c.created_at
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING m.*;
+$$ LANGUAGE sql;
+
+-- 积压判断：只统计现在就能被认领的文本消息。not_before 未到 (超额或失败退避) 的行不计入；
+-- 该用户有处理中 / 已入批次 / 被延后的消息时，其余消息只是在排队等它，同样不计入，
+-- 避免单个用户的延后消息把所有人的新消息推进 24 小时完成窗口的 Batch API
+-- 调用: supabase.rpc("feishu_backlog_stats", {}) -> [{"depth": N, "oldest_created_at": ...}]
+CREATE OR REPLACE FUNCTION public.feishu_backlog_stats()
+RETURNS TABLE (depth BIGINT, oldest_created_at TIMESTAMP WITH TIME ZONE) AS $$
+    SELECT COUNT(*), MIN(c.created_at)
+    FROM public.feishu_messages c
+    WHERE c.status = 'pending'
+      AND c.event_type = 'message'
+      AND (c.not_before IS NULL OR c.not_before <= NOW())
+      AND NOT EXISTS (
+          SELECT 1 FROM public.feishu_messages blocker
+          WHERE blocker.sender_id = c.sender_id
+            AND (blocker.status IN ('processing', 'batched')
+                 OR (blocker.status = 'pending' AND blocker.not_before > NOW()))
+      );
+$$ LANGUAGE sql STABLE;
+
+-- 认领时按用户检查更早的 pending / 进行中的消息
+CREATE INDEX IF NOT EXISTS idx_feishu_messages_pending_sender
+    ON public.feishu_messages(sender_id, created_at)
+    WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_feishu_messages_busy_sender
+    ON public.feishu_messages(sender_id)
+    WHERE status IN ('processing', 'batched');
+
+-- 崩溃遗留行的回收扫描
+CREATE INDEX IF NOT EXISTS idx_feishu_messages_processing
+    ON public.feishu_messages(updated_at)
+    WHERE status = 'processing';
+
+-- ---------------------------------------------------------------------------
+-- 飞书回复发件箱 (Transactional Outbox)：回复与消息完成状态同事务写入，由投递器异步发送并重试
+-- ---------------------------------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS public.feishu_outbox (
+    id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+    record_id UUID UNIQUE REFERENCES public.feishu_messages(id) ON DELETE SET NULL, -- 来源消息，同一消息只回复一次
+    receive_id TEXT NOT NULL,                  -- 接收方 open_id
+    card JSONB NOT NULL,                       -- 渲染好的互动卡片
+    status TEXT DEFAULT 'pending' NOT NULL,    -- 状态: pending, sending, sent, failed
+    attempts INTEGER DEFAULT 0 NOT NULL,
+    next_attempt_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL,
+    last_error TEXT,
+    sent_at TIMESTAMP WITH TIME ZONE,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_feishu_outbox_due
+    ON public.feishu_outbox(next_attempt_at)
+    WHERE status = 'pending';
+
+DROP TRIGGER IF EXISTS trg_feishu_outbox_updated_at ON public.feishu_outbox;
+CREATE TRIGGER trg_feishu_outbox_updated_at
+    BEFORE UPDATE ON public.feishu_outbox
+    FOR EACH ROW EXECUTE FUNCTION public.set_updated_at();
+
+-- Worker 调用：写入发件箱并把消息标记为 completed (函数体在单个事务内执行)
+CREATE OR REPLACE FUNCTION public.enqueue_feishu_reply(p_record_id UUID, p_receive_id TEXT, p_card JSONB)
+RETURNS VOID AS $$
+BEGIN
+    INSERT INTO public.feishu_outbox (record_id, receive_id, card)
+    VALUES (p_record_id, p_receive_id, p_card)
+    ON CONFLICT (record_id) DO NOTHING;
+
+    UPDATE public.feishu_messages
+    SET status = 'completed', stage = 'completed'
+    WHERE id = p_record_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 投递器调用：原子认领到期的待发送回复 (sending 状态超时视为投递器崩溃，重新认领)
+CREATE OR REPLACE FUNCTION public.claim_feishu_outbox(
+    p_limit INTEGER DEFAULT 20,
+    p_stale_after INTERVAL DEFAULT INTERVAL '5 minutes'
+)
+RETURNS SETOF public.feishu_outbox AS $$
+    UPDATE public.feishu_outbox o
+    SET status = 'sending'
+    WHERE o.id IN (
+        SELECT id FROM public.feishu_outbox
+        WHERE (status = 'pending' AND next_attempt_at <= NOW())
+           OR (status = 'sending' AND updated_at < NOW() - p_stale_after)
+        ORDER BY next_attempt_at
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING o.*;
+$$ LANGUAGE sql;
@@ -6,6 +6,180 @@ const supabaseServiceKey = Deno.env.get('SUPABASE_SERVICE_ROLE_KEY')!
 
 const supabase = createClient(supabaseUrl, supabaseServiceKey)
 
+// 快速应答：先回 200 给飞书，入库放到后台 (EdgeRuntime.waitUntil) 完成，避免慢应答触发飞书重试
+// 注意：飞书收到 200 后不会再重试，后台入库失败的消息只能依靠下面的重试与错误日志兜底
+const FAST_ACK = Deno.env.get('FEISHU_FAST_ACK') === '1'
+const FAST_ACK_RETRIES = Number(Deno.env.get('FEISHU_FAST_ACK_RETRIES') || '3')
+// 微批入库：窗口期内到达的消息合并为一次 upsert (0 表示逐条入库)
+const BATCH_WINDOW_MS = Number(Deno.env.get('FEISHU_BATCH_WINDOW_MS') || '0')
+const BATCH_MAX_SIZE = Number(Deno.env.get('FEISHU_BATCH_MAX_SIZE') || '50')
+// 本实例内近期已见过的事件，重试风暴在到达数据库之前就被挡掉
+const DEDUP_TTL_MS = Number(Deno.env.get('FEISHU_DEDUP_TTL_MS') || '600000')
+const DEDUP_MAX_ENTRIES = 5000
+
+// 只处理这些飞书事件类型，其余直接确认并忽略
+const MESSAGE_EVENT_TYPE = 'im.message.receive_v1'
+const CARD_ACTION_EVENT_TYPE = 'card.action.trigger'
+const ACCEPTED_EVENT_TYPES = new Set([MESSAGE_EVENT_TYPE, CARD_ACTION_EVENT_TYPE])
+
+// 紧急信号词，与 agent.py 中 TaskClassifier.detect_urgency 保持一致；命中即为 P0 插队处理
+const URGENT_SIGNALS = ['急', '问题', '故障', '出事', '客户', '紧急']
+
+type MessageRow = {
+    message_id: string
+    content: string
+    sender_id: string
+    status: string
+    priority: number
+    event_type: 'message' | 'card_action'
+}
+
+// 0 = P0 (紧急), 1 = P1 (默认)
+function detectPriority(text: string): number {
+    const lowered = text.toLowerCase()
+    return URGENT_SIGNALS.some((signal) => lowered.includes(signal)) ? 0 : 1
+}
+
+const jsonResponse = (body: unknown, status = 200) =>
+    new Response(JSON.stringify(body), {
+        status,
+        headers: { 'Content-Type': 'application/json' },
+    })
+
+// ---------------------------------------------------------------------------
+// 实例内去重 (event_id / message_id)，数据库层由 message_id UNIQUE + ON CONFLICT DO NOTHING 兜底
+// ---------------------------------------------------------------------------
+const recentEvents = new Map<string, number>()
+
+function seenRecently(key: string): boolean {
+    const now = Date.now()
+    const seenAt = recentEvents.get(key)
+    if (seenAt !== undefined && now - seenAt < DEDUP_TTL_MS) {
+        return true
+    }
+    recentEvents.set(key, now)
+    // Map 按插入顺序迭代，超出容量时淘汰最旧的记录
+    while (recentEvents.size > DEDUP_MAX_ENTRIES) {
+        const oldest = recentEvents.keys().next().value
+        recentEvents.delete(oldest)
+    }
+    return false
+}
+
+// ---------------------------------------------------------------------------
+// 幂等入库：upsert + ignoreDuplicates 即 INSERT ... ON CONFLICT (message_id) DO NOTHING
+// ---------------------------------------------------------------------------
+async function upsertRows(rows: MessageRow[]) {
+    const { error } = await supabase
+        .from('feishu_messages')
+        .upsert(rows, { onConflict: 'message_id', ignoreDuplicates: true })
+    if (error) {
+        throw new Error(error.message)
+    }
+}
+
+let pendingRows: MessageRow[] = []
+let pendingFlush: Promise<void> | null = null
+let flushTimer: number | null = null
+let resolveFlush: (() => void) | null = null
+let rejectFlush: ((e: Error) => void) | null = null
+
+function flushBatch() {
+    if (flushTimer !== null) {
+        clearTimeout(flushTimer)
+        flushTimer = null
+    }
+    const rows = pendingRows
+    const resolve = resolveFlush!
+    const reject = rejectFlush!
+    pendingRows = []
+    pendingFlush = null
+    resolveFlush = null
+    rejectFlush = null
+
+    upsertRows(rows).then(resolve, reject)
+}
+
+// 将消息加入当前微批，返回该批次写入完成的 Promise (同批请求共享结果)
+function enqueueRow(row: MessageRow): Promise<void> {
+    if (BATCH_WINDOW_MS <= 0) {
+        return upsertRows([row])
+    }
+    // 同一批次内 message_id 重复会导致 upsert 报错，这里直接复用已排队的那条
+    if (!pendingRows.some((r) => r.message_id === row.message_id)) {
+        pendingRows.push(row)
+    }
+    if (!pendingFlush) {
+        pendingFlush = new Promise<void>((resolve, reject) => {
+            resolveFlush = resolve
+            rejectFlush = reject
+        })
+        flushTimer = setTimeout(flushBatch, BATCH_WINDOW_MS)
+    }
+    const flush = pendingFlush
+    if (pendingRows.length >= BATCH_MAX_SIZE) {
+        flushBatch()
+    }
+    return flush
+}
+
+// 快速应答模式下的后台入库：失败后逐条重试 (upsert 幂等，可安全重放)，仍失败则输出完整消息便于人工补录
+async function storeInBackground(row: MessageRow, stored: Promise<void>) {
+    let lastError: Error | null = null
+    try {
+        await stored
+        return
+    } catch (e) {
+        lastError = e
+    }
+    for (let attempt = 1; attempt <= FAST_ACK_RETRIES; attempt++) {
+        await new Promise((resolve) => setTimeout(resolve, 200 * 2 ** (attempt - 1)))
+        try {
+            await upsertRows([row])
+            console.warn(`Fast-ack insert of ${row.message_id} succeeded on retry ${attempt}`)
+            return
+        } catch (e) {
+            lastError = e
+        }
+    }
+    console.error(
+        `[MESSAGE LOST] Fast-ack insert failed after ${FAST_ACK_RETRIES} retries, Feishu will not redeliver:`,
+        lastError?.message,
+        JSON.stringify(row)
+    )
+}
+
+// 卡片回调需在 3 秒内应答，返回 toast 提示；入库与文本消息共用幂等/微批路径
+async function handleCardAction(header: Record<string, any>, event: Record<string, any>) {
+    const actionPayload = event.action?.value?.payload
+    const sender_id = event.operator?.open_id || 'default_boss'
+    const eventKey = header.event_id || event.token
+
+    if (!actionPayload) {
+        return jsonResponse({ toast: { type: 'info', content: '该按钮无需处理' } })
+    }
+    if (eventKey && seenRecently(eventKey)) {
+        return jsonResponse({ toast: { type: 'info', content: '已收到，正在处理' } })
+    }
+
+    try {
+        await enqueueRow({
+            message_id: `card_${eventKey || Date.now()}`,
+            content: String(actionPayload),
+            sender_id: sender_id,
+            status: 'pending',
+            priority: 0,  // 按钮点击是即时交互，优先处理
+            event_type: 'card_action'
+        })
+    } catch (e) {
+        console.error('Error inserting card action into Supabase:', e.message)
+        if (eventKey) recentEvents.delete(eventKey)
+        return jsonResponse({ toast: { type: 'error', content: '操作提交失败，请重试' } })
+    }
+
+    return jsonResponse({ toast: { type: 'success', content: '遵旨' } })
+}
+
 serve(async (req) => {
     // Only accept POST requests
     if (req.method !== 'POST') {
@@ -17,27 +191,43 @@ serve(async (req) => {
 
         // 1. 验证挑战码 (Challenge)
         if (payload.challenge && payload.type === 'url_verification') {
-            return new Response(JSON.stringify({ challenge: payload.challenge }), {
-                headers: { 'Content-Type': 'application/json' },
-            })
+            return jsonResponse({ challenge: payload.challenge })
         }
 
         // 2. 忽略不需要的事件或消息类型
         if (!payload.event) {
-            return new Response(JSON.stringify({ status: 'ignored', msg: 'No event found' }), {
-                headers: { 'Content-Type': 'application/json' },
-            })
+            return jsonResponse({ status: 'ignored', msg: 'No event found' })
+        }
+
+        const header = payload.header || {}
+        if (header.event_type && !ACCEPTED_EVENT_TYPES.has(header.event_type)) {
+            return jsonResponse({ status: 'ignored', msg: `Unsupported event type: ${header.event_type}` })
         }
 
         const event = payload.event
+
+        // 卡片按钮回调：作为 card_action 事件入队，Worker 直接分发到本地处理器，不经过 LLM
+        if (header.event_type === CARD_ACTION_EVENT_TYPE) {
+            return await handleCardAction(header, event)
+        }
+
         const message = event.message || {}
         const sender = event.sender || {}
 
+        // 忽略机器人自身或其他应用发出的消息，避免回复触发新一轮处理
+        if (sender.sender_type && sender.sender_type !== 'user') {
+            return jsonResponse({ status: 'ignored', msg: 'Not sent by a user' })
+        }
+
         // 我们在这个 Demo 里只处理文本消息
         if (message.message_type !== 'text') {
-            return new Response(JSON.stringify({ status: 'ignored', msg: 'Not a text message' }), {
-                headers: { 'Content-Type': 'application/json' },
-            })
+            return jsonResponse({ status: 'ignored', msg: 'Not a text message' })
+        }
+
+        // 飞书重试时 event_id 与 message_id 均不变，命中即直接确认
+        const dedupKey = header.event_id || message.message_id
+        if (dedupKey && seenRecently(dedupKey)) {
+            return jsonResponse({ status: 'duplicate', msg: 'Event already received' })
         }
 
         let user_message = ''
@@ -53,32 +243,40 @@ serve(async (req) => {
         const message_id = message.message_id || `msg_${Date.now()}`
 
         if (!user_message.trim()) {
-            return new Response(JSON.stringify({ status: 'ignored', msg: 'Empty message' }), {
-                headers: { 'Content-Type': 'application/json' },
-            })
+            return jsonResponse({ status: 'ignored', msg: 'Empty message' })
         }
 
-        // 3. 将消息存入 Supabase feishu_messages 供 Worker 处理
-        const { error } = await supabase
-            .from('feishu_messages')
-            .insert({
-                message_id: message_id,
-                content: user_message,
-                sender_id: sender_id,
-                status: 'pending'
-            })
-
-        if (error) {
-            console.error('Error inserting into Supabase:', error)
-            return new Response(JSON.stringify({ error: error.message }), { status: 500 })
+        // 3. 将消息存入 Supabase feishu_messages 供 Worker 处理 (重复消息静默忽略)
+        const row: MessageRow = {
+            message_id: message_id,
+            content: user_message,
+            sender_id: sender_id,
+            status: 'pending',
+            priority: detectPriority(user_message),
+            event_type: 'message'
         }
+        const stored = enqueueRow(row)
 
-        return new Response(JSON.stringify({ status: 'success', msg: 'Message received and stored' }), {
-            headers: { 'Content-Type': 'application/json' },
-        })
+        // @ts-ignore EdgeRuntime 为 Supabase Edge Runtime 注入的全局对象
+        if (FAST_ACK && typeof EdgeRuntime !== 'undefined') {
+            // @ts-ignore
+            EdgeRuntime.waitUntil(storeInBackground(row, stored))
+            return jsonResponse({ status: 'accepted', msg: 'Message received' })
+        }
+
+        try {
+            await stored
+        } catch (e) {
+            console.error('Error inserting into Supabase:', e.message)
+            // 入库失败时允许飞书重试再次进入
+            if (dedupKey) recentEvents.delete(dedupKey)
+            return jsonResponse({ error: e.message }, 500)
+        }
+
+        return jsonResponse({ status: 'success', msg: 'Message received and stored' })
 
     } catch (error) {
         console.error('Server error:', error.message)
-        return new Response(JSON.stringify({ error: 'Invalid Request' }), { status: 400 })
+        return jsonResponse({ error: 'Invalid Request' }, 400)
     }
 })
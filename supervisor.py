@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+多进程 Worker 守护进程 (Supervisor)
+在单机上启动 N 个 worker 进程共享 feishu_messages 认领队列，负责健康检查、崩溃重启，
+并通过一个 HTTP 端点对外暴露所有进程的聚合指标。
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from worker import WorkerStats, process_pending_messages
+
+# 使用 spawn 启动子进程，避免 fork 继承 supervisor 的 HTTP 线程与锁状态
+MP_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def run_worker_process(index: int, workers: int, concurrency: int, stats: WorkerStats):
+    """子进程入口：第 index 个进程负责第 index 个用户分片 (重启后仍是同一分片)；
+    只有 0 号进程负责积压批处理与发件箱投递，避免重复提交批次、分散飞书限流额度"""
+    try:
+        asyncio.run(process_pending_messages(
+            concurrency=concurrency, stats=stats,
+            batch_enabled=(index == 0), outbox_enabled=(index == 0),
+            shard=index, shards=workers
+        ))
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerSlot:
+    """一个 worker 槽位：进程句柄 + 跨重启保留的共享指标"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.stats = WorkerStats()
+        self.process: Optional[multiprocessing.Process] = None
+        self.restarts = 0
+        self.started_at = 0.0
+        self.next_start_at: Optional[float] = None  # 等待退避重启的时间点，None 表示未在等待
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+    def __init__(self, workers: int, concurrency: int, heartbeat_timeout: float, restart_backoff: float = 1.0):
+        self.concurrency = concurrency
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_backoff = restart_backoff
+        self.slots: List[WorkerSlot] = [WorkerSlot(i) for i in range(workers)]
+        self.stopping = False
+
+    # -------------------------- 进程管理 --------------------------
+
+    def start_slot(self, slot: WorkerSlot):
+        slot.stats.beat()
+        slot.process = MP_CONTEXT.Process(
+            target=run_worker_process,
+            args=(slot.index, len(self.slots), self.concurrency, slot.stats),
+            name=f"cabinet-worker-{slot.index}",
+            daemon=True
+        )
+        slot.process.start()
+        slot.started_at = time.time()
+        print(f"🚀 [Supervisor] worker-{slot.index} 已启动 (pid {slot.process.pid})")
+
+    def check_slot(self, slot: WorkerSlot):
+        """健康检查：进程退出或心跳超时则安排重启；退避期间跳过该槽位，不阻塞其他槽位与信号处理"""
+        if slot.next_start_at is not None:
+            if time.time() >= slot.next_start_at and not self.stopping:
+                slot.next_start_at = None
+                self.start_slot(slot)
+            return
+
+        if not slot.alive():
+            exitcode = slot.process.exitcode if slot.process else None
+            print(f"❌ [Supervisor] worker-{slot.index} 已退出 (exitcode {exitcode})，准备重启")
+        elif time.time() - slot.stats.heartbeat.value > self.heartbeat_timeout:
+            print(f"❌ [Supervisor] worker-{slot.index} 心跳超时 {self.heartbeat_timeout}s，强制重启")
+            slot.process.terminate()
+            slot.process.join(5)
+            if slot.process.is_alive():
+                slot.process.kill()
+                slot.process.join()
+        else:
+            return
+
+        # 连续崩溃时指数退让，避免重启风暴 (稳定运行超过 60 秒后重置)
+        if time.time() - slot.started_at > 60:
+            slot.restarts = 0
+        delay = min(self.restart_backoff * (2 ** slot.restarts), 60)
+        slot.restarts += 1
+        slot.next_start_at = time.time() + delay
+        print(f"[Supervisor] worker-{slot.index} 将在 {delay:.0f}s 后重启")
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def run(self, poll_interval: float = 2.0):
+        for slot in self.slots:
+            self.start_slot(slot)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping:
+            for slot in self.slots:
+                if self.stopping:
+                    break
+                self.check_slot(slot)
+            time.sleep(poll_interval)
+
+        print("[Supervisor] 正在停止所有 worker...")
+        for slot in self.slots:
+            if slot.alive():
+                slot.process.terminate()
+        for slot in self.slots:
+            if slot.process:
+                slot.process.join(10)
+
+    # -------------------------- 聚合指标 --------------------------
+
+    def snapshot(self) -> Dict:
+        now = time.time()
+        workers = []
+        for slot in self.slots:
+            workers.append({
+                "index": slot.index,
+                "pid": slot.process.pid if slot.process else None,
+                "alive": slot.alive(),
+                "heartbeat_age": round(now - slot.stats.heartbeat.value, 3),
+                "processed": slot.stats.processed.value,
+                "errors": slot.stats.errors.value,
+                "in_flight": slot.stats.in_flight.value,
+                "restarts": slot.restarts,
+                "prompt_tokens": {name: v.value for name, v in slot.stats.prompt_tokens.items()},
+                "cached_tokens": {name: v.value for name, v in slot.stats.cached_tokens.items()},
+            })
+        healthy = all(w["alive"] and w["heartbeat_age"] <= self.heartbeat_timeout for w in workers)
+
+        # 各部门跨进程汇总的 Prompt 缓存命中率
+        prompt_cache = {}
+        for name in (self.slots[0].stats.prompt_tokens if self.slots else {}):
+            prompt_tokens = sum(w["prompt_tokens"][name] for w in workers)
+            cached_tokens = sum(w["cached_tokens"][name] for w in workers)
+            prompt_cache[name] = {
+                "prompt_tokens": prompt_tokens,
+                "cached_tokens": cached_tokens,
+                "hit_rate": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+            }
+        return {
+            "healthy": healthy,
+            "processed": sum(w["processed"] for w in workers),
+            "errors": sum(w["errors"] for w in workers),
+            "in_flight": sum(w["in_flight"] for w in workers),
+            "prompt_cache": prompt_cache,
+            "workers": workers,
+        }
+
+    def prometheus(self) -> str:
+        snap = self.snapshot()
+        lines = [
+            "# TYPE cabinet_worker_up gauge",
+            "# TYPE cabinet_messages_processed_total counter",
+            "# TYPE cabinet_messages_errors_total counter",
+            "# TYPE cabinet_messages_in_flight gauge",
+            "# TYPE cabinet_worker_restarts_total counter",
+            "# TYPE cabinet_prompt_tokens_total counter",
+            "# TYPE cabinet_prompt_cached_tokens_total counter",
+        ]
+        for w in snap["workers"]:
+            label = f'{{worker="{w["index"]}"}}'
+            lines.append(f"cabinet_worker_up{label} {int(w['alive'])}")
+            lines.append(f"cabinet_messages_processed_total{label} {w['processed']}")
+            lines.append(f"cabinet_messages_errors_total{label} {w['errors']}")
+            lines.append(f"cabinet_messages_in_flight{label} {w['in_flight']}")
+            lines.append(f"cabinet_worker_restarts_total{label} {w['restarts']}")
+            for name in w["prompt_tokens"]:
+                agent_label = f'{{worker="{w["index"]}",agent="{name}"}}'
+                lines.append(f"cabinet_prompt_tokens_total{agent_label} {w['prompt_tokens'][name]}")
+                lines.append(f"cabinet_prompt_cached_tokens_total{agent_label} {w['cached_tokens'][name]}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(supervisor: Supervisor, port: int):
+    """/metrics 输出 Prometheus 文本格式，/health 输出 JSON (不健康时返回 503)"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = supervisor.prometheus().encode("utf-8")
+                content_type = "text/plain; version=0.0.4"
+                status = 200
+            elif self.path == "/health":
+                snap = supervisor.snapshot()
+                body = json.dumps(snap, ensure_ascii=False).encode("utf-8")
+                content_type = "application/json"
+                status = 200 if snap["healthy"] else 503
+            else:
+                self.send_error(404)
+                return
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # 避免抓取指标刷屏
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    print(f"📈 [Supervisor] 指标端点已启动: http://0.0.0.0:{port}/metrics")
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="虚拟内阁多进程 Worker 守护进程")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WORKER_PROCESSES", os.cpu_count() or 1)), help="worker 进程数 (默认 CPU 核数)")
+    parser.add_argument("--concurrency", type=int, default=int(os.environ.get("WORKER_CONCURRENCY", "4")), help="每个进程同时处理的消息数")
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get("METRICS_PORT", "9100")), help="聚合指标 HTTP 端口，0 表示不启动")
+    parser.add_argument("--heartbeat-timeout", type=float, default=float(os.environ.get("WORKER_HEARTBEAT_TIMEOUT", "60")), help="心跳超时秒数，超时即重启进程")
+    args = parser.parse_args()
+
+    supervisor = Supervisor(args.workers, args.concurrency, args.heartbeat_timeout)
+    if args.metrics_port:
+        serve_metrics(supervisor, args.metrics_port)
+    supervisor.run()
+    sys.exit(0)
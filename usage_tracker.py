@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, Optional, Any
+
+# ---------------------------------------------------------------------------
+# 用量与配额：按 (用户, 部门, 模型, 分钟) 记录 Token 与费用的滚动窗口，
+# 在分发前检查用户配额，超额用户降级到便宜模型或延后处理，避免单个用户挤占全队的 TPM 额度。
+# 同机多进程共享同一个 SQLite 文件，配额在整个主机范围内生效。
+# ---------------------------------------------------------------------------
+
+USAGE_DB_PATH = os.environ.get("USAGE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "usage.db"))
+
+QUOTA_OK = "ok"
+QUOTA_DOWNGRADE = "downgrade"
+QUOTA_DEFER = "defer"
+
+
+class QuotaExceededError(Exception):
+    """用户超出配额，消息需延后处理"""
+
+    def __init__(self, user_id: str, retry_after: int):
+        super().__init__(f"用户 {user_id} 超出用量配额，{retry_after} 秒后重试")
+        self.user_id = user_id
+        self.retry_after = retry_after
+
+
+def load_quota_config() -> Dict[str, Any]:
+    config_path = os.path.join(os.path.dirname(__file__), "config", "quota_config.json")
+    if os.path.exists(config_path):
+        with open(config_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+class UsageTracker:
+    def __init__(self, model_prices: Optional[Dict[str, float]] = None, path: str = USAGE_DB_PATH,
+                 quota_config: Optional[Dict[str, Any]] = None):
+        # model -> 每千 Token 单价，来自 agents_config.json 中 tiers 的 cost_per_1k_tokens
+        self.model_prices = model_prices or {}
+        self.config = quota_config if quota_config is not None else load_quota_config()
+        self.window_seconds = int(self.config.get("window_seconds", 3600))
+        self.lock = threading.Lock()
+        self._last_prune = 0.0
+
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_minutes (
+                user_id TEXT NOT NULL,
+                minute INTEGER NOT NULL,
+                agent TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, minute, agent, model)
+            )
+        """)
+
+    # -------------------------- 记录 --------------------------
+
+    def record(self, user_id: str, agent_name: str, model: str, usage) -> None:
+        """记录一次调用的 usage (SDK 对象或批次结果中的 dict)，聚合到分钟桶"""
+        if usage is None:
+            return
+        if isinstance(usage, dict):
+            prompt_tokens = usage.get("prompt_tokens") or 0
+            completion_tokens = usage.get("completion_tokens") or 0
+        else:
+            prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+            completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        cost = (prompt_tokens + completion_tokens) / 1000 * self.model_prices.get(model, 0.0)
+        minute = int(time.time() // 60)
+
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO usage_minutes (user_id, minute, agent, model, prompt_tokens, completion_tokens, cost)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, minute, agent, model) DO UPDATE SET
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    cost = cost + excluded.cost
+            """, (user_id, minute, agent_name, model, prompt_tokens, completion_tokens, cost))
+            self._prune(minute)
+
+    def _prune(self, minute: int):
+        """每分钟最多清理一次窗口外的旧桶，保持存储紧凑"""
+        if time.time() - self._last_prune < 60:
+            return
+        self._last_prune = time.time()
+        self.conn.execute("DELETE FROM usage_minutes WHERE minute < ?", (minute - self.window_seconds // 60 - 1,))
+
+    # -------------------------- 查询 --------------------------
+
+    def usage_since(self, user_id: str, seconds: int) -> Dict[str, float]:
+        since = int((time.time() - seconds) // 60)
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0), COALESCE(SUM(cost), 0)
+                FROM usage_minutes WHERE user_id = ? AND minute > ?
+            """, (user_id, since)).fetchone()
+        return {"tokens": row[0], "cost": round(row[1], 6)}
+
+    def summary(self, user_id: str) -> Dict[str, Dict[str, int]]:
+        """窗口内按 部门/模型 拆分的用量"""
+        since = int((time.time() - self.window_seconds) // 60)
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT agent, model, SUM(prompt_tokens), SUM(completion_tokens), SUM(cost)
+                FROM usage_minutes WHERE user_id = ? AND minute > ?
+                GROUP BY agent, model
+            """, (user_id, since)).fetchall()
+        return {
+            f"{agent}/{model}": {"prompt_tokens": p, "completion_tokens": c, "cost": round(cost, 6)}
+            for agent, model, p, c, cost in rows
+        }
+
+    # -------------------------- 配额 --------------------------
+
+    def _limits(self, user_id: str) -> Dict[str, float]:
+        limits = dict(self.config.get("default", {}))
+        limits.update(self.config.get("users", {}).get(user_id, {}))
+        return limits
+
+    def check_quota(self, user_id: str) -> str:
+        """返回 ok / downgrade / defer；未配置配额时始终为 ok"""
+        limits = self._limits(user_id)
+        if not limits:
+            return QUOTA_OK
+
+        ratios = []
+        if limits.get("tokens_per_minute"):
+            ratios.append(self.usage_since(user_id, 60)["tokens"] / limits["tokens_per_minute"])
+        if limits.get("tokens_per_window") or limits.get("cost_per_window"):
+            window = self.usage_since(user_id, self.window_seconds)
+            if limits.get("tokens_per_window"):
+                ratios.append(window["tokens"] / limits["tokens_per_window"])
+            if limits.get("cost_per_window"):
+                ratios.append(window["cost"] / limits["cost_per_window"])
+
+        ratio = max(ratios, default=0.0)
+        if ratio >= self.config.get("defer_at", 1.0):
+            return QUOTA_DEFER
+        if ratio >= self.config.get("downgrade_at", 0.8):
+            return QUOTA_DOWNGRADE
+        return QUOTA_OK
+
+    @property
+    def defer_seconds(self) -> int:
+        return int(self.config.get("defer_seconds", 60))
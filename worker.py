@@ -1,89 +1,207 @@
 import os
+import sys
 import json
 import time
 import asyncio
-from supabase import create_client, Client
-import httpx
+import argparse
+import subprocess
+import statistics
+import multiprocessing
+from datetime import datetime, timedelta, timezone
+from typing import Optional, TYPE_CHECKING
 
-from agent_manager import CabinetManager
+# openai / requests 在首次调用大模型或 Notion 时才导入；supabase 在建立队列连接时导入 (首次认领前必需)
+if TYPE_CHECKING:
+    from supabase import Client
 
-# 1. 飞书发送函数的实现 (用于将卡片发给用户)
-async def send_feishu_card(user_id: str, card_blocks: list, coach_message: str):
-    app_id = os.environ.get("FEISHU_APP_ID")
-    app_secret = os.environ.get("FEISHU_APP_SECRET")
-    
-    if not app_id or not app_secret:
-        print("警告: 缺少 FEISHU_APP_ID 或 FEISHU_APP_SECRET，无法真正发送飞书消息。")
+from agent_manager import load_agents_config, CabinetManager, AgentResponse, FrontEnd, RouterPlan, MessageCheckpoint
+from action_handlers import dispatch_card_action, confirmation_buttons
+from batch_processor import BatchCoordinator
+from feishu_outbox import FeishuOutboxDispatcher, build_feishu_card, enqueue_reply
+from usage_tracker import QuotaExceededError
+
+MAX_ATTEMPTS = int(os.environ.get("WORKER_MAX_ATTEMPTS", "3"))  # 单条消息最多尝试次数，超过后标记 error
+RETRY_BACKOFF_BASE = float(os.environ.get("WORKER_RETRY_BACKOFF_BASE", "10"))  # 失败重试的退避基数 (秒)，每次失败翻倍
+RETRY_BACKOFF_MAX = float(os.environ.get("WORKER_RETRY_BACKOFF_MAX", "300"))   # 单次退避上限 (秒)
+WARMUP_ENABLED = os.environ.get("WORKER_WARMUP", "1") == "1"     # 启动后在后台预热连接与 Prompt
+WARMUP_TIMEOUT = float(os.environ.get("WORKER_WARMUP_TIMEOUT", "5"))
+LOWEST_PRIORITY = 9  # 超额延后的消息每次降一级优先级，最低到该值
+
+# 1. 处理检查点：各阶段结果写回 feishu_messages，重试时从最后完成的阶段续跑
+def save_stage(supabase: "Client", record_id: str, stage: str, **fields):
+    supabase.table("feishu_messages").update({"stage": stage, **fields}).eq("id", record_id).execute()
+
+def build_checkpoint(supabase: "Client", record: dict) -> MessageCheckpoint:
+    record_id = record["id"]
+    plan = RouterPlan.model_validate(record["router_plan"]) if record.get("router_plan") else None
+    results = {int(k): v for k, v in (record.get("department_results") or {}).items()}
+
+    def on_plan(plan: RouterPlan):
+        save_stage(supabase, record_id, "routed", router_plan=plan.model_dump(mode="json"))
+
+    def on_result(results: dict):
+        supabase.table("feishu_messages").update({
+            "department_results": {str(k): v for k, v in results.items()}
+        }).eq("id", record_id).execute()
+
+    return MessageCheckpoint(plan=plan, results=results, on_plan=on_plan, on_result=on_result)
+
+def handle_failure(supabase: "Client", record: dict, error: Exception):
+    """失败后退回 pending 并按指数退避设置 not_before (已完成的阶段不会重跑)，超过最大次数则标记 error
+
+    退避让短暂的 Notion / Supabase 故障不会在几秒内耗尽全部重试次数。
+    """
+    attempts = (record.get("attempts") or 0) + 1
+    status = "pending" if attempts < MAX_ATTEMPTS else "error"
+    delay = min(RETRY_BACKOFF_BASE * 2 ** (attempts - 1), RETRY_BACKOFF_MAX)
+    not_before = datetime.now(timezone.utc) + timedelta(seconds=delay)
+    retry_note = f"，{delay:.0f} 秒后重试" if status == "pending" else ""
+    print(f"处理消息 [{record['id']}] 第 {attempts} 次失败，状态置为 {status}{retry_note}: {error}")
+    supabase.table("feishu_messages").update({
+        "status": status,
+        "attempts": attempts,
+        "last_error": str(error)[:1000],
+        "not_before": not_before.isoformat()
+    }).eq("id", record["id"]).execute()
+
+def defer_record(supabase: "Client", record: dict, error: QuotaExceededError):
+    """用户超出配额：退回 pending 并降低优先级，not_before 之前不会被再次认领 (不计入失败次数)"""
+    priority = record.get("priority")
+    priority = min((1 if priority is None else priority) + 1, LOWEST_PRIORITY)
+    not_before = datetime.now(timezone.utc) + timedelta(seconds=error.retry_after)
+    print(f"⏳ 消息 [{record['id']}] 延后 {error.retry_after} 秒处理，优先级降为 P{priority}: {error}")
+    supabase.table("feishu_messages").update({
+        "status": "pending",
+        "priority": priority,
+        "not_before": not_before.isoformat()
+    }).eq("id", record["id"]).execute()
+
+# 2. 常规完成路径：执行 Notion 动作 -> 写入飞书发件箱并标记 completed (交互与积压批处理共用)
+async def complete_record(supabase: "Client", manager: CabinetManager, record: dict, agent_response):
+    record_id = record["id"]
+    user_id = record["sender_id"]
+    stage = record.get("stage")
+
+    if stage == "completed":
+        # 回复已写入发件箱 (与完成状态同事务)，不再重复保存回复或执行 Notion 动作
+        print(f"[Checkpoint] 消息 [{record_id}] 已完成，跳过")
+        supabase.table("feishu_messages").update({"status": "completed"}).eq("id", record_id).execute()
         return
 
-    # a. 获取 tenant_access_token
-    token_url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal"
-    req_body = {"app_id": app_id, "app_secret": app_secret}
+    # 持久化最终回复：之后的步骤失败时，重试无需再调用任何大模型
+    if stage not in ("responded", "actions_done"):
+        save_stage(supabase, record_id, "responded", agent_response=agent_response.model_dump(mode="json"))
+
+    # 获取卡片所需数据 (待确认的任务 / 灵感附加携带本消息 ID 的确认按钮，点击后走本地快速通道写入 Notion)
+    coach_message = agent_response.front_end.coach_message
+    buttons = confirmation_buttons(record_id, agent_response.actions) + agent_response.front_end.buttons
     
-    async with httpx.AsyncClient() as client:
-        try:
-            resp = await client.post(token_url, json=req_body)
-            resp.raise_for_status()
-            access_token = resp.json().get("tenant_access_token")
-        except Exception as e:
-            print(f"获取飞书 Token 失败: {e}")
-            return
+    # 打印日志
+    print("========== 拟返回飞书卡片 (Worker) ==========")
+    print(f"💬 教练留言: \n{coach_message}\n")
+    for btn in buttons:
+        icon = "🔴" if btn.recommended else "⚪"
+        print(f"  {icon} [{btn.text}] (Payload: {btn.action_payload})")
+    
+    # 如果有 notion 动作，执行同步动作 (重试时已执行过则跳过，避免重复写入 Notion)
+    if stage != "actions_done":
+        await manager.execute_actions(agent_response.actions)
+        save_stage(supabase, record_id, "actions_done")
+    
+    # 渲染卡片写入发件箱，并在同一事务内标记 completed；实际投递由 FeishuOutboxDispatcher 异步完成
+    enqueue_reply(supabase, record_id, user_id, build_feishu_card(buttons, coach_message))
 
-        if not access_token:
-            return
+# 3. 卡片按钮快速通道：本地处理器直接执行，仅在处理器显式要求时才调用 LLM
+async def handle_card_action(supabase: "Client", manager: CabinetManager, user_id: str, payload: str) -> Optional[AgentResponse]:
+    result = await dispatch_card_action(manager, user_id, payload, supabase)
+    if result.llm_message:
+        return await manager.process_message(result.llm_message, user_id)
+    if result.reply:
+        return AgentResponse(front_end=FrontEnd(coach_message=result.reply, buttons=result.buttons))
+    # 无需回复 (如 "朕已阅")
+    return None
 
-        # b. 组装卡片 JSON (简化)
-        # 实际开发中可以根据 agent_manager 的 Button 构建互动卡片，或者是 markdown 文本
-        card_content = {
-            "config": {"wide_screen_mode": True},
-            "header": {
-                "title": {"tag": "plain_text", "content": "内阁总管回复"}
-            },
-            "elements": [
-                {
-                    "tag": "markdown",
-                    "content": coach_message
-                }
-            ]
-        }
-        
-        # 将按钮追加为 Action
-        if card_blocks:
-            action_element = {
-                "tag": "action",
-                "actions": []
-            }
-            for btn in card_blocks:
-                button_type = "primary" if btn.recommended else "default"
-                action_element["actions"].append({
-                    "tag": "button",
-                    "text": {"tag": "plain_text", "content": btn.text},
-                    "type": button_type,
-                    "value": {"payload": btn.action_payload}
-                })
-            card_content["elements"].append(action_element)
-
-        # c. 发送消息
-        send_url = "https://open.feishu.cn/open-apis/im/v1/messages?receive_id_type=open_id"
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "receive_id": user_id,
-            "msg_type": "interactive",
-            "content": json.dumps(card_content)
-        }
-        
-        try:
-            send_resp = await client.post(send_url, headers=headers, json=payload)
-            send_resp.raise_for_status()
-            print(f"✅ 已成功回复飞书用户 {user_id}")
-        except Exception as e:
-            print(f"发送飞书失败: {e}")
+# 4. Worker 运行指标 (共享内存，supervisor 可跨进程读取并聚合)
+class WorkerStats:
+    """单个 Worker 进程的心跳与计数器，每个字段只由所属进程写入"""
+
+    def __init__(self, agents: Optional[list] = None):
+        self.heartbeat = multiprocessing.Value("d", time.time(), lock=False)
+        self.processed = multiprocessing.Value("q", 0, lock=False)
+        self.errors = multiprocessing.Value("q", 0, lock=False)
+        self.in_flight = multiprocessing.Value("i", 0, lock=False)
+        # 按部门统计 Prompt Token 与其中命中前缀缓存的 Token (部门列表在创建时确定，共享内存无法动态扩容)
+        agents = agents if agents is not None else list(load_agents_config())
+        self.prompt_tokens = {name: multiprocessing.Value("q", 0, lock=False) for name in agents}
+        self.cached_tokens = {name: multiprocessing.Value("q", 0, lock=False) for name in agents}
+
+    def beat(self):
+        self.heartbeat.value = time.time()
 
-# 2. Worker 轮询与处理逻辑
-async def process_pending_messages():
+    def record_prompt_cache(self, agent_name: str, prompt_tokens: int, cached_tokens: int):
+        if agent_name in self.prompt_tokens:
+            self.prompt_tokens[agent_name].value += prompt_tokens
+            self.cached_tokens[agent_name].value += cached_tokens
+
+# 5. 单条消息处理
+async def process_record(supabase: "Client", manager: CabinetManager, record: dict, stats: WorkerStats):
+    record_id = record["id"]
+    user_message = record["content"]
+    user_id = record["sender_id"]
+
+    print(f"\n🔔 检测到新消息 [{record_id}] 来自 {user_id}: {user_message}")
+    stats.in_flight.value += 1
+    try:
+        # 处理消息：已有最终回复的检查点直接复用，卡片按钮走本地快速通道，其余调用 CabinetManager
+        if record.get("agent_response"):
+            print(f"[Checkpoint] 消息 [{record_id}] 已生成回复 (阶段 {record.get('stage')})，仅重试后续步骤")
+            agent_response = AgentResponse.model_validate(record["agent_response"])
+        elif record.get("event_type") == "card_action":
+            agent_response = await handle_card_action(supabase, manager, user_id, user_message)
+            if agent_response is None:
+                supabase.table("feishu_messages").update({"status": "completed"}).eq("id", record_id).execute()
+                stats.processed.value += 1
+                return
+        else:
+            agent_response = await manager.process_message(user_message, user_id, checkpoint=build_checkpoint(supabase, record))
+
+        if agent_response:
+            # 执行动作、回复飞书并标记 completed
+            await complete_record(supabase, manager, record, agent_response)
+            stats.processed.value += 1
+        else:
+            print("❌ Router 返回为空，标记为 error")
+            supabase.table("feishu_messages").update({"status": "error"}).eq("id", record_id).execute()
+            stats.errors.value += 1
+    except QuotaExceededError as e:
+        defer_record(supabase, record, e)
+    except Exception as e:
+        handle_failure(supabase, record, e)
+        stats.errors.value += 1
+    finally:
+        stats.in_flight.value -= 1
+
+# 6. 冷启动预热：后台预建 OpenAI / Notion / 飞书连接并预读 Prompt，不阻塞认领循环
+async def warm_up(manager: CabinetManager, outbox: Optional[FeishuOutboxDispatcher] = None,
+                  timeout: float = WARMUP_TIMEOUT):
+    started = time.perf_counter()
+    jobs = [manager.warm_up(timeout)]
+    if outbox:
+        jobs.append(outbox.warm_up())
+    try:
+        await asyncio.wait_for(asyncio.gather(*jobs), timeout=timeout * 2)
+    except asyncio.TimeoutError:
+        print(f"[Warm-up] 预热超时 ({timeout * 2:.0f}s)，剩余连接将在首个请求时建立")
+    print(f"🔥 [Warm-up] 预热完成，耗时 {(time.perf_counter() - started) * 1000:.0f} ms")
+
+# 7. Worker 轮询与处理逻辑
+async def process_pending_messages(concurrency: int = 1, stats: Optional[WorkerStats] = None,
+                                   batch_enabled: bool = True, outbox_enabled: bool = True,
+                                   shard: int = 0, shards: int = 1):
+    """轮询并处理消息。concurrency 为本进程同时处理的消息数；多进程部署时由 supervisor.py 启动多个实例
+
+    shard / shards 按 sender_id 划分用户：每个用户只由一个进程处理，会话记忆 (进程内) 因此保持完整有序。
+    """
     # 初始化 Supabase
     supabase_url = os.environ.get("SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY") # 用 service role 以免受 RLS 限制
@@ -92,65 +210,142 @@ async def process_pending_messages():
         print("🔴 缺少 Supabase 环境变量 (SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)")
         return
         
-    supabase: Client = create_client(supabase_url, supabase_key)
+    from supabase import create_client
+    supabase: "Client" = create_client(supabase_url, supabase_key)
     manager = CabinetManager()
+    stats = stats or WorkerStats()
+    manager.prompt_cache_stats.listener = stats.record_prompt_cache
+
+    # 积压模式：队列过深或过旧时改走 Batch API，结果回流到 complete_record
+    async def on_batch_complete(record: dict, agent_response):
+        await complete_record(supabase, manager, record, agent_response)
+
+    # 与发件箱一样作为独立后台任务运行，批次结果回流期间认领循环与心跳照常进行
+    if batch_enabled and os.environ.get("BATCH_MODE_ENABLED", "1") == "1":
+        batch_coordinator = BatchCoordinator(
+            supabase, manager, on_complete=on_batch_complete,
+            on_failure=lambda record, error: handle_failure(supabase, record, error),
+            on_defer=lambda record, error: defer_record(supabase, record, error)
+        )
+        batch_task = asyncio.create_task(batch_coordinator.run())  # 保留引用，防止任务被回收
 
-    print("🚀 启动 Supabase Worker，正在轮询 feishu_messages...")
+    # 飞书回复投递与消息处理解耦，作为独立后台任务运行 (也可单独运行 feishu_outbox.py)
+    outbox = None
+    if outbox_enabled and os.environ.get("OUTBOX_DISPATCHER_IN_WORKER", "1") == "1":
+        outbox = FeishuOutboxDispatcher(supabase)
+        outbox_task = asyncio.create_task(outbox.run())  # 保留引用，防止任务被回收
+
+    # 预热与轮询并行：认领循环立即开始，连接通常在首条消息到达前就已建立
+    if WARMUP_ENABLED:
+        warmup_task = asyncio.create_task(warm_up(manager, outbox))
+
+    print(f"🚀 启动 Supabase Worker (分片 {shard}/{shards}，并发 {concurrency})，正在轮询 feishu_messages...")
+    in_flight = set()
     
     while True:
+        stats.beat()
         try:
-            # 1. 查找待处理记录
-            # 使用 limit(1) 保证一次处理一条，也可以用 in_ 代替
-            response = supabase.table("feishu_messages").select("*").eq("status", "pending").order("created_at").limit(1).execute()
-            data = response.data
-            
-            if data and len(data) > 0:
-                record = data[0]
-                record_id = record["id"]
-                user_message = record["content"]
-                user_id = record["sender_id"]
-                
-                print(f"\n🔔 检测到新消息 [{record_id}] 来自 {user_id}: {user_message}")
-                
-                # 2. 锁定记录为 processing
-                supabase.table("feishu_messages").update({"status": "processing"}).eq("id", record_id).execute()
-                
-                # 3. 处理消息 (调用 CabinetManager)
-                agent_response = await manager.process_message(user_message, user_id)
-                
-                if agent_response:
-                    # 获取卡片所需数据
-                    coach_message = agent_response.front_end.coach_message
-                    buttons = agent_response.front_end.buttons
-                    
-                    # 打印日志
-                    print("========== 拟返回飞书卡片 (Worker) ==========")
-                    print(f"💬 教练留言: \n{coach_message}\n")
-                    for btn in buttons:
-                        icon = "🔴" if btn.recommended else "⚪"
-                        print(f"  {icon} [{btn.text}] (Payload: {btn.action_payload})")
-                    
-                    # 4. 如果有 notion 动作，执行同步动作
-                    await manager.execute_actions(agent_response.actions)
-                    
-                    # 5. 回复飞书用户
-                    await send_feishu_card(user_id, buttons, coach_message)
-                    
-                    # 6. 更新状态为 completed
-                    supabase.table("feishu_messages").update({"status": "completed"}).eq("id", record_id).execute()
+            # 1. 按空闲槽位原子认领本分片的待处理记录 (同一用户同时最多一条，多进程不会重复认领)
+            free_slots = concurrency - len(in_flight)
+            records = []
+            if free_slots > 0:
+                response = supabase.rpc("claim_feishu_messages", {
+                    "p_limit": free_slots, "p_shard": shard, "p_shards": shards, "p_max_attempts": MAX_ATTEMPTS
+                }).execute()
+                records = response.data or []
+
+            # 2. 每条记录作为独立任务并发处理
+            for record in records:
+                task = asyncio.create_task(process_record(supabase, manager, record, stats))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+
+            if not records:
+                # 没消息或槽位已满时等待：有任务完成即醒来，否则最多休眠 2 秒
+                if in_flight:
+                    await asyncio.wait(in_flight, timeout=2, return_when=asyncio.FIRST_COMPLETED)
                 else:
-                    print("❌ Router 返回为空，标记为 error")
-                    supabase.table("feishu_messages").update({"status": "error"}).eq("id", record_id).execute()
-            else:
-                # 没消息时稍微休眠
-                await asyncio.sleep(2)
+                    await asyncio.sleep(2)
                 
         except Exception as e:
             print(f"Worker 轮询发生异常: {e}")
+            stats.errors.value += 1
             await asyncio.sleep(5) # 出错后退让
 
+# 8. 冷启动基准：每轮在全新解释器中测量各阶段耗时，直到完成首次认领往返
+_STARTUP_PROBE = """
+import os, sys, time, json, asyncio
+phases = {}
+t = time.perf_counter()
+import worker
+phases["import"] = time.perf_counter() - t
+t = time.perf_counter()
+manager = worker.CabinetManager()
+phases["construct"] = time.perf_counter() - t
+url, key = os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+if url and key:
+    t = time.perf_counter()
+    from supabase import create_client
+    phases["supabase_import"] = time.perf_counter() - t
+    t = time.perf_counter()
+    supabase = create_client(url, key)
+    phases["connect"] = time.perf_counter() - t
+    # p_limit=0 只走一次认领往返、不取走消息 (同样会回收超时的 processing 行，与任一 Worker 的行为一致)
+    t = time.perf_counter()
+    supabase.rpc("claim_feishu_messages", {"p_limit": 0, "p_shard": 0, "p_shards": 1,
+                                           "p_max_attempts": worker.MAX_ATTEMPTS}).execute()
+    phases["first_claim"] = time.perf_counter() - t
+# 首次认领时仍未导入的模块才是真正推迟到冷启动之后的开销
+deferred = [m for m in ("openai", "httpx", "requests") if m not in sys.modules]
+if %(warmup)r:
+    t = time.perf_counter()
+    asyncio.run(worker.warm_up(manager))
+    phases["warm_up"] = time.perf_counter() - t
+print(json.dumps({"phases": phases, "deferred": deferred}))
+"""
+
+READY_PHASES = ("import", "construct", "supabase_import", "connect", "first_claim")
+
+def benchmark_startup(runs: int = 5, warmup: bool = False):
+    """打印各阶段的中位耗时；ready 为进程启动到完成首次 claim_feishu_messages 往返 (即可开始处理消息) 的总耗时"""
+    probe = _STARTUP_PROBE % {"warmup": warmup}
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            print(result.stderr)
+            return
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    print(f"⏱️ 冷启动基准 ({runs} 轮，全新进程，中位数)")
+    measured = list(samples[-1]["phases"])
+    for phase in measured:
+        print(f"  {phase:<16} {statistics.median(s['phases'][phase] for s in samples) * 1000:8.1f} ms")
+    ready = statistics.median(sum(s["phases"].get(p, 0.0) for p in READY_PHASES) for s in samples)
+    if "first_claim" in measured:
+        print(f"  {'ready':<16} {ready * 1000:8.1f} ms  (完成首次认领往返，可开始处理消息)")
+    else:
+        print(f"  {'ready':<16} {ready * 1000:8.1f} ms  (不含 Supabase 导入、建连与首次认领：未设置 SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY)")
+    stage = "首次认领后" if "first_claim" in measured else "构造后"
+    print(f"  {stage}仍未导入: {', '.join(samples[-1]['deferred']) or '无'}")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="虚拟内阁 Worker")
+    parser.add_argument("--benchmark-startup", action="store_true", help="测量冷启动各阶段耗时后退出")
+    parser.add_argument("--benchmark-runs", type=int, default=5, help="冷启动基准轮数")
+    parser.add_argument("--benchmark-warmup", action="store_true", help="基准中同时测量预热 (需要网络与 API Key)")
+    args = parser.parse_args()
+
+    if args.benchmark_startup:
+        benchmark_startup(args.benchmark_runs, args.benchmark_warmup)
+        sys.exit(0)
+
     try:
-        asyncio.run(process_pending_messages())
+        asyncio.run(process_pending_messages(
+            concurrency=int(os.environ.get("WORKER_CONCURRENCY", "1")),
+            shard=int(os.environ.get("WORKER_SHARD", "0")),
+            shards=int(os.environ.get("WORKER_SHARDS", "1"))
+        ))
     except KeyboardInterrupt:
         print("Worker 已停止。")